@@ -0,0 +1,148 @@
+import subprocess
+import numpy as np
+from faster_whisper.audio import decode_audio
+from faster_whisper.vad import VadOptions, get_speech_timestamps
+
+SAMPLING_RATE = 16000
+
+
+class TimelineMap:
+    """
+    Maps the timestamps of the preprocessed audio back to the original audio.
+
+    The preprocessed audio is the concatenation of the kept intervals of the original audio, played `tempo`
+    times faster: a time t of it is t * tempo seconds into the concatenation, inside the kept interval i
+    with starts[i] <= t * tempo < starts[i + 1], i.e. at sources[i] + t * tempo - starts[i] in the original.
+    """
+
+    def __init__(self, intervals, tempo=1.0):
+        """
+        :param intervals: kept [(start, end)] of the original audio, seconds, in order
+        """
+        intervals = np.asarray(intervals, dtype=np.float64).reshape(-1, 2)
+        lengths = intervals[:, 1] - intervals[:, 0]
+        self.sources = intervals[:, 0]
+        self.starts = np.concatenate(([0.0], np.cumsum(lengths)[:-1])) if len(lengths) else np.zeros(1)
+        if not len(lengths):
+            self.sources = np.zeros(1)
+        self.tempo = tempo
+
+    def to_original(self, t, side='right'):
+        """
+        :param side: 'right' for start times, 'left' for end times, so that a time at the junction of two
+                     intervals maps to the start of the next one, or to the end of the previous one
+        """
+        t = np.asarray(t, dtype=np.float64) * self.tempo
+        i = np.clip(np.searchsorted(self.starts, t, side=side) - 1, 0, len(self.starts) - 1)
+        return self.sources[i] + t - self.starts[i]
+
+    def segment(self, start, duration):
+        """
+        :return: (start, duration) of a transcript line on the original timeline
+        """
+        original_start = float(self.to_original(start))
+        original_end = float(self.to_original(start + duration, side='left'))
+        return original_start, max(original_end - original_start, 0.0)
+
+
+class AudioPreprocessor:
+    """
+    Shorten the audio before whisper: silences are cut out (silero VAD, or an energy threshold which is
+    cheaper) and the rest is sped up by `tempo` with ffmpeg's atempo filter, which keeps the pitch.
+    Transcription time is about proportional to the audio length, so talk shows and podcasts get a lot faster.
+
+    :param method: vad or energy
+    :param min_silence_ms: shorter silences are kept
+    :param padding_ms: kept around every speech interval
+    :param energy_threshold_db: frames quieter than this (dBFS) are silence, energy method only
+    :param tempo: 1 = no speed-up, at most 2
+    """
+
+    def __init__(self, method='vad', min_silence_ms=700, padding_ms=200, energy_threshold_db=-40, tempo=1.0):
+        self.method = method
+        self.min_silence_ms = min_silence_ms
+        self.padding_ms = padding_ms
+        self.energy_threshold_db = energy_threshold_db
+        self.tempo = min(max(tempo, 0.5), 2.0)  # range of a single atempo filter
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        :param config: faster_whisper.preprocess section of the config, None if preprocessing is disabled
+        """
+        if not config.get('enabled'):
+            return None
+        return cls(config.get('method', 'vad'), config.get('min_silence_ms', 700), config.get('padding_ms', 200),
+                   config.get('energy_threshold_db', -40), config.get('tempo', 1.0))
+
+    def process(self, audio):
+        """
+        :param audio: path of an audio file, or 16 kHz mono float32 samples
+        :return: (samples, TimelineMap) of the preprocessed audio
+        """
+        if isinstance(audio, str):
+            audio = decode_audio(audio, sampling_rate=SAMPLING_RATE)
+        intervals = self.vad_intervals(audio) if self.method == 'vad' else self.energy_intervals(audio)
+        if intervals:
+            trimmed = np.concatenate([audio[start:end] for start, end in intervals])
+        else:
+            trimmed = audio[:0]
+
+        tempo = self.tempo
+        if tempo != 1.0 and len(trimmed):
+            sped_up = change_tempo(trimmed, tempo)
+            if sped_up is None:
+                tempo = 1.0
+            else:
+                trimmed = sped_up
+        print(f"audio preprocessed: {len(audio) / SAMPLING_RATE:.0f} -> {len(trimmed) / SAMPLING_RATE:.0f} seconds")
+        return trimmed, TimelineMap([(start / SAMPLING_RATE, end / SAMPLING_RATE) for start, end in intervals], tempo)
+
+    def vad_intervals(self, audio):
+        vad_options = VadOptions(min_silence_duration_ms=self.min_silence_ms, speech_pad_ms=self.padding_ms)
+        return [(speech['start'], speech['end']) for speech in get_speech_timestamps(audio, vad_options)]
+
+    def energy_intervals(self, audio, frame_ms=30):
+        """
+        Sample intervals of the frames louder than energy_threshold_db, padded, with the short silences kept.
+        """
+        frame = SAMPLING_RATE * frame_ms // 1000
+        n = len(audio) // frame
+        if n == 0:
+            return [(0, len(audio))] if len(audio) else []
+        rms = np.sqrt(np.mean(np.square(audio[:n * frame].reshape(n, frame)), axis=1))
+        voiced = 20 * np.log10(rms + 1e-10) > self.energy_threshold_db
+
+        ## runs of voiced frames: [starts, ends)
+        edges = np.diff(np.concatenate(([0], voiced.astype(np.int8), [0])))
+        starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+        pad = self.padding_ms // frame_ms
+        min_gap = self.min_silence_ms // frame_ms
+        intervals = []
+        for start, end in zip((starts - pad).clip(0).tolist(), (ends + pad).clip(max=n).tolist()):
+            if intervals and start - intervals[-1][1] < min_gap:
+                intervals[-1][1] = end
+            else:
+                intervals.append([start, end])
+        last = len(audio)
+        return [(start * frame, last if end == n else end * frame) for start, end in intervals]
+
+
+def change_tempo(samples, tempo):
+    """
+    Speed up the samples with ffmpeg atempo (pitch preserved), through pipes.
+
+    :return: the new samples, None if ffmpeg is not available or failed
+    """
+    pcm = (np.clip(samples, -1, 1) * 32767).astype(np.int16).tobytes()
+    cmd = ['ffmpeg', '-nostdin', '-loglevel', 'error', '-f', 's16le', '-ar', str(SAMPLING_RATE), '-ac', '1',
+           '-i', '-', '-filter:a', f'atempo={tempo}', '-f', 's16le', '-']
+    try:
+        result = subprocess.run(cmd, input=pcm, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        print("ffmpeg not found, audio not sped up")
+        return None
+    if result.returncode != 0:
+        print(f"ffmpeg atempo failed, audio not sped up: {result.stderr.decode(errors='ignore')[-500:]}")
+        return None
+    return np.frombuffer(result.stdout, np.int16).astype(np.float32) / 32768.0
@@ -0,0 +1,176 @@
+import json
+import re
+import xml.etree.ElementTree as ET
+import utils
+from transcript import Transcript
+
+DEFAULT_LANGUAGES = ["zh-Hans", "zh-Hant", "zh-TW", "zh"]
+DEFAULT_FORMATS = ["json3", "srv3", "vtt"]
+
+
+def parse_json3(data):
+    return json3_transcript(json.loads(data))
+
+
+def json3_transcript(subtitle_json):
+    """
+    youtube json3 captions: {"events": [{"tStartMs", "dDurationMs", "segs": [{"utf8"}, ...]}, ...]}
+    Automatic captions split a line in one seg per word, so all the segs of an event are joined.
+    """
+    events = subtitle_json.get('events', [])
+    rows = []
+    for item in events:
+        text = ''.join(seg.get('utf8', '') for seg in item.get('segs') or []).strip()
+        if not text:  # window / line break events of automatic captions
+            continue
+        rows.append((item['tStartMs'] / 1000, item.get('dDurationMs', 0) / 1000, text))
+    return Transcript.from_rows(rows)
+
+
+def parse_srv3(data):
+    """
+    youtube timedtext format 3: <timedtext><body><p t="start ms" d="duration ms">text or <s>word</s>...</p>
+    """
+    root = ET.fromstring(data)
+    rows = []
+    for p in root.iter('p'):
+        text = ''.join(p.itertext()).strip()
+        if not text:
+            continue
+        rows.append((int(p.get('t', 0)) / 1000, int(p.get('d', 0)) / 1000, text))
+    return Transcript.from_rows(rows)
+
+
+VTT_TIMING = re.compile(r'((?:\d+:)?\d{2}:\d{2}\.\d{3})\s+-->\s+((?:\d+:)?\d{2}:\d{2}\.\d{3})')
+VTT_TAG = re.compile(r'<[^>]+>')
+
+
+def vtt_seconds(timestamp):
+    seconds = 0
+    for part in timestamp.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def parse_vtt(data):
+    """
+    WebVTT cues. Automatic captions repeat the previous line at the top of every cue (rolling captions),
+    lines equal to the previous one are skipped.
+    """
+    rows = []
+    last_line = None
+    ## cues are separated by empty lines, automatic captions also have lines made of a space inside the cues
+    for block in re.split(r'\n\n+', data.replace('\r\n', '\n')):
+        lines = block.strip().split('\n')
+        for i, line in enumerate(lines):
+            match = VTT_TIMING.search(line)
+            if match is None:
+                continue
+            start, end = vtt_seconds(match.group(1)), vtt_seconds(match.group(2))
+            for text in lines[i + 1:]:
+                text = VTT_TAG.sub('', text).strip()
+                if text and text != last_line:
+                    rows.append((start, end - start, text))
+                    last_line = text
+            break
+    return Transcript.from_rows(rows)
+
+
+PARSERS = {"json3": parse_json3, "srv3": parse_srv3, "vtt": parse_vtt}
+
+
+class CaptionResolver:
+    """
+    Pick the best captions of a video among its manual subtitles and youtube's automatic captions,
+    so that whisper only runs on videos without any captions.
+
+    Candidates, in order:
+        1. manual subtitles in the preferred languages
+        2. automatic captions of the spoken language, in the preferred languages
+        3. if any_language: manual subtitles, then automatic captions of the spoken language, in any language
+        4. if translated: automatic captions machine-translated to the preferred languages
+    A language matches its regional variants ("zh" matches "zh-TW"). Every candidate is tried in the
+    preferred formats, until one downloads and parses into a non-empty transcript.
+    """
+
+    def __init__(self, languages=None, formats=None, any_language=True, translated=True):
+        self.languages = languages or DEFAULT_LANGUAGES
+        self.formats = [ext for ext in formats or DEFAULT_FORMATS if ext in PARSERS]
+        self.any_language = any_language
+        self.translated = translated
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        :param config: the captions section of the config
+        """
+        return cls(config.get('languages'), config.get('formats'), config.get('any_language', True),
+                   config.get('translated', True))
+
+    def preferred(self, tracks):
+        """
+        :return: the languages of `tracks` matching the preferred languages, in the order of preference
+        """
+        result = []
+        for lang in self.languages:
+            result += [key for key in tracks if (key == lang or key.startswith(lang + '-')) and key not in result]
+        return result
+
+    @staticmethod
+    def is_translated(formats):
+        return any('tlang=' in item.get('url', '') for item in formats)
+
+    def candidates(self, info_dict):
+        """
+        :return: [(source, lang, formats)] in the order they should be tried
+        """
+        manual = info_dict.get('subtitles') or {}
+        auto = info_dict.get('automatic_captions') or {}
+        spoken = {lang: formats for lang, formats in auto.items() if not self.is_translated(formats)}
+        translated = {lang: formats for lang, formats in auto.items() if self.is_translated(formats)}
+
+        preferred_manual = self.preferred(manual)
+        preferred_spoken = self.preferred(spoken)
+        result = [("manual", lang, manual[lang]) for lang in preferred_manual]
+        result += [("auto", lang, spoken[lang]) for lang in preferred_spoken]
+        if self.any_language:
+            result += [("manual", lang, formats) for lang, formats in manual.items() if lang not in preferred_manual]
+            result += [("auto", lang, formats) for lang, formats in spoken.items() if lang not in preferred_spoken]
+        if self.translated:
+            result += [("auto", lang, translated[lang]) for lang in self.preferred(translated)]
+        return result
+
+    def choose_format(self, formats):
+        """
+        :return: the track of the first preferred format available, None if there is none
+        """
+        for ext in self.formats:
+            for item in formats:
+                if item.get('ext') == ext and item.get('url'):
+                    return item
+        return None
+
+    def resolve(self, info_dict):
+        """
+        :return: (srt, source) of the best usable captions, source is "manual" or "auto"; (None, None) if none
+        """
+        for source, lang, formats in self.candidates(info_dict):
+            track = self.choose_format(formats)
+            if track is None:
+                continue
+            try:
+                srt = self.download(track)
+            except Exception as e:  # broken track, try the next one
+                print(f"{source} captions {lang} ({track['ext']}) failed: {repr(e)}")
+                continue
+            if len(srt):
+                print(f"using {source} captions {lang} ({track['ext']})")
+                return srt, source
+        return None, None
+
+    @staticmethod
+    def download(track):
+        response = utils.get_http_responce(track['url'], 'GET', None)
+        if response.status != 200:
+            raise ValueError(f"status {response.status}")
+        return PARSERS[track['ext']](response.data.decode('utf-8'))
@@ -0,0 +1,168 @@
+import datetime
+import json
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import redis
+
+
+class ConversationStore(ABC):
+    """
+    Chat histories of OpenAIHelper, with the token count of every message stored next to it.
+
+    A history starts with its system message. At most `max_messages` messages follow it, the oldest
+    ones are dropped first. A history not updated for `max_age_minutes` expires.
+    """
+
+    def __init__(self, max_age_minutes=180, max_messages=30):
+        self.max_age_minutes = max_age_minutes
+        self.max_messages = max_messages
+
+    @abstractmethod
+    def get(self, chat_id):
+        """
+        :return: (messages, token_counts), or None if the chat has no (unexpired) history
+        """
+
+    @abstractmethod
+    def reset(self, chat_id, message, tokens):
+        """
+        Start a new history made of the system message.
+        """
+
+    @abstractmethod
+    def append(self, chat_id, message, tokens):
+        """
+        Add a message after the last one, the oldest ones are dropped above max_messages.
+        """
+
+    @abstractmethod
+    def trim(self, chat_id, size):
+        """
+        Keep the system message and the last size - 1 messages.
+        """
+
+
+class InMemoryConversationStore(ConversationStore):
+    """
+    Histories in the memory of the process, lost on restart.
+    """
+
+    def __init__(self, max_age_minutes=180, max_messages=30):
+        super().__init__(max_age_minutes, max_messages)
+        self.conversations: dict[int: list] = {}  # {chat_id: history}
+        self.token_counts: dict[int: list] = {}  # {chat_id: [tokens of every message of the history]}
+        # {chat_id: last_update_timestamp}, least recently updated first, so expired chats are found at the front
+        self.last_updated: OrderedDict[int: datetime] = OrderedDict()
+
+    def get(self, chat_id):
+        self.evict_expired()
+        if chat_id not in self.conversations:
+            return None
+        return self.conversations[chat_id], self.token_counts[chat_id]
+
+    def reset(self, chat_id, message, tokens):
+        self.conversations[chat_id] = [message]
+        self.token_counts[chat_id] = [tokens]
+        self.touch(chat_id)
+
+    def append(self, chat_id, message, tokens):
+        if chat_id not in self.conversations:
+            return
+        messages, token_counts = self.conversations[chat_id], self.token_counts[chat_id]
+        messages.append(message)
+        token_counts.append(tokens)
+        if len(messages) > self.max_messages + 1:
+            del messages[1:len(messages) - self.max_messages]
+            del token_counts[1:len(token_counts) - self.max_messages]
+        self.touch(chat_id)
+
+    def trim(self, chat_id, size):
+        if chat_id not in self.conversations:
+            return
+        drop = max(len(self.conversations[chat_id]) - max(size, 1), 0)
+        del self.conversations[chat_id][1:1 + drop]
+        del self.token_counts[chat_id][1:1 + drop]
+
+    def touch(self, chat_id):
+        self.last_updated[chat_id] = datetime.datetime.now()
+        self.last_updated.move_to_end(chat_id)
+
+    def evict_expired(self):
+        """
+        Drops the conversations older than max_age_minutes. last_updated is in LRU order,
+        so only the expired chats at its front are visited.
+        """
+        expire_before = datetime.datetime.now() - datetime.timedelta(minutes=self.max_age_minutes)
+        while self.last_updated:
+            chat_id, last_updated = next(iter(self.last_updated.items()))
+            if last_updated >= expire_before:
+                break
+            del self.last_updated[chat_id]
+            self.conversations.pop(chat_id, None)
+            self.token_counts.pop(chat_id, None)
+
+
+class RedisConversationStore(ConversationStore):
+    """
+    Histories in redis, shared by all the bot processes, so any of them can serve any chat:
+        <prefix>:<chat_id>:system    the system message
+        <prefix>:<chat_id>:messages  capped list of the other messages, {"message": ..., "tokens": ...}
+    Both keys expire max_age_minutes after the last update, the expiration is native.
+    """
+
+    def __init__(self, redis_client: redis.Redis, prefix="conversation", max_age_minutes=180, max_messages=30):
+        super().__init__(max_age_minutes, max_messages)
+        self.redis_client = redis_client
+        self.prefix = prefix
+        self.ttl = int(max_age_minutes * 60)
+
+    def keys(self, chat_id):
+        return f"{self.prefix}:{chat_id}:system", f"{self.prefix}:{chat_id}:messages"
+
+    def get(self, chat_id):
+        system_key, messages_key = self.keys(chat_id)
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.get(system_key)
+        pipe.lrange(messages_key, 0, -1)
+        system, entries = pipe.execute()
+        if system is None:
+            return None
+        entries = [json.loads(system)] + [json.loads(entry) for entry in entries]
+        return [entry["message"] for entry in entries], [entry["tokens"] for entry in entries]
+
+    def reset(self, chat_id, message, tokens):
+        system_key, messages_key = self.keys(chat_id)
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.set(system_key, json.dumps({"message": message, "tokens": tokens}), ex=self.ttl)
+        pipe.delete(messages_key)
+        pipe.execute()
+
+    def append(self, chat_id, message, tokens):
+        system_key, messages_key = self.keys(chat_id)
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.rpush(messages_key, json.dumps({"message": message, "tokens": tokens}))
+        pipe.ltrim(messages_key, -self.max_messages, -1)
+        pipe.expire(messages_key, self.ttl)
+        pipe.expire(system_key, self.ttl)
+        pipe.execute()
+
+    def trim(self, chat_id, size):
+        _, messages_key = self.keys(chat_id)
+        if size > 1:
+            self.redis_client.ltrim(messages_key, -(size - 1), -1)
+        else:
+            self.redis_client.delete(messages_key)
+
+
+def create_conversation_store(config, redis_client: redis.Redis = None) -> ConversationStore:
+    """
+    Build the store described by config['conversation_store'] ("memory" or "redis").
+    """
+    max_age_minutes = config['max_conversation_age_minutes']
+    max_messages = config.get('max_stored_messages', config['max_history_size'] * 2)
+    if config.get('conversation_store', 'memory') == 'redis':
+        if redis_client is None:
+            redis_client = redis.Redis(
+                host=config['redis_info']['host'], port=config['redis_info']['port'], decode_responses=True)
+        return RedisConversationStore(redis_client, max_age_minutes=max_age_minutes, max_messages=max_messages)
+    return InMemoryConversationStore(max_age_minutes, max_messages)
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+import redis
+
+
+def payload_key(payload):
+    """
+    Content address of a chat request: hash of the model, the messages (role prompt + segment text)
+    and the temperature.
+    """
+    content = {
+        "model": payload.get("engine") or payload.get("model"),
+        "messages": payload["messages"],
+        "temperature": payload.get("temperature"),
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class LLMCache(ABC):
+    """
+    Cache of the assistant replies, so a retried or re-added video costs no tokens.
+    Entries expire after `ttl` seconds, and the least recently used ones are evicted above `max_entries`.
+    """
+
+    def __init__(self, ttl=3600 * 24 * 30, max_entries=100000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, payload):
+        reply = self._get(payload_key(payload))
+        if reply is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return reply
+
+    def put(self, payload, reply):
+        if reply:  # never cache failed (empty) replies
+            self._put(payload_key(payload), reply)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0}
+
+    @abstractmethod
+    def _get(self, key):
+        """
+        :return: the reply cached under key, None on a miss
+        """
+
+    @abstractmethod
+    def _put(self, key, reply):
+        pass
+
+
+class DiskLLMCache(LLMCache):
+    """
+    sqlite file backend, for a single summarizer node.
+
+    Reads do not write: the access times of the hits are kept in memory and written with the next put,
+    and expired / least recently used entries are evicted every `evict_interval` seconds, not on every put,
+    so the table may exceed max_entries for a while.
+    """
+
+    def __init__(self, path, ttl=3600 * 24 * 30, max_entries=100000, evict_interval=600):
+        super().__init__(ttl, max_entries)
+        self.evict_interval = evict_interval
+        self.last_evict = 0
+        self.accessed = {}  # key: access time not written yet
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS llm_cache "
+                        "(key TEXT PRIMARY KEY, reply TEXT, created REAL, accessed REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed)")
+        self.db.commit()
+
+    def _get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT reply, created FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:  # removed by the next eviction
+                return None
+            self.accessed[key] = now
+            return row[0]
+
+    def _put(self, key, reply):
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?)", (key, reply, now, now))
+            self.accessed.pop(key, None)
+            self.write_accessed()
+            if now - self.last_evict > self.evict_interval:
+                self.evict(now)
+            self.db.commit()
+
+    def write_accessed(self):
+        if self.accessed:
+            self.db.executemany("UPDATE llm_cache SET accessed = ? WHERE key = ?",
+                                [(accessed, key) for key, accessed in self.accessed.items()])
+            self.accessed = {}
+
+    def evict(self, now):
+        self.last_evict = now
+        self.db.execute("DELETE FROM llm_cache WHERE created < ?", (now - self.ttl,))
+        self.db.execute("DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache "
+                        "ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+
+class RedisLLMCache(LLMCache):
+    """
+    redis backend, shared by all the summarizer nodes. TTL is native, LRU order is kept in a sorted set.
+    """
+
+    def __init__(self, redis_client: redis.Redis, prefix="llm_cache", ttl=3600 * 24 * 30, max_entries=100000):
+        super().__init__(ttl, max_entries)
+        self.redis_client = redis_client
+        self.prefix = prefix
+        self.lru_key = f"{prefix}:lru"
+
+    def _get(self, key):
+        reply = self.redis_client.get(f"{self.prefix}:{key}")
+        if reply is not None:
+            self.redis_client.zadd(self.lru_key, {key: time.time()})
+        return reply
+
+    def _put(self, key, reply):
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.set(f"{self.prefix}:{key}", reply, ex=int(self.ttl))
+        pipe.zadd(self.lru_key, {key: time.time()})
+        pipe.zremrangebyscore(self.lru_key, '-inf', time.time() - self.ttl)  # expired by their ttl already
+        pipe.zcard(self.lru_key)
+        size = pipe.execute()[-1]
+        if size > self.max_entries:
+            evicted = [k for k, _ in self.redis_client.zpopmin(self.lru_key, size - self.max_entries)]
+            self.redis_client.delete(*(f"{self.prefix}:{k}" for k in evicted))
+
+
+def create_llm_cache(config):
+    """
+    Build the cache described by config['openai']['cache'], None if caching is disabled.
+    """
+    cache_config = config['openai'].get('cache', {})
+    backend = cache_config.get('backend', 'none')
+    ttl = cache_config.get('ttl', 3600 * 24 * 30)
+    max_entries = cache_config.get('max_entries', 100000)
+    if backend == 'disk':
+        return DiskLLMCache(cache_config.get('path', 'llm_cache.sqlite3'), ttl, max_entries,
+                            cache_config.get('evict_interval', 600))
+    if backend == 'redis':
+        redis_client = redis.Redis(
+            host=config['redis_info']['host'], port=config['redis_info']['port'], decode_responses=True)
+        return RedisLLMCache(redis_client, ttl=ttl, max_entries=max_entries)
+    return None
@@ -0,0 +1,57 @@
+import threading
+
+
+class LLMUsage:
+    """
+    Per-role accounting of the chat requests: number of calls, latency, prompt / completion tokens and cost,
+    to tune which model every role is routed to from real numbers.
+
+    Prices are per 1000 tokens, from the "price" setting of the role ({"prompt": ..., "completion": ...}).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.roles = {}
+
+    def record(self, role, model, latency, usage, price=None):
+        """
+        :param latency: seconds of the successful attempt
+        :param usage: the "usage" field of the response
+        """
+        prompt_tokens = usage.get('prompt_tokens', 0) if usage else 0
+        completion_tokens = usage.get('completion_tokens', 0) if usage else 0
+        price = price or {}
+        cost = (prompt_tokens * price.get('prompt', 0) + completion_tokens * price.get('completion', 0)) / 1000
+        with self.lock:
+            stats = self.roles.setdefault(role, {"model": model, "calls": 0, "latency": 0.0, "max_latency": 0.0,
+                                                 "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0})
+            stats["model"] = model
+            stats["calls"] += 1
+            stats["latency"] += latency
+            stats["max_latency"] = max(stats["max_latency"], latency)
+            stats["prompt_tokens"] += prompt_tokens
+            stats["completion_tokens"] += completion_tokens
+            stats["cost"] += cost
+        return cost
+
+    def stats(self):
+        """
+        :return: {role: {model, calls, avg_latency, max_latency, prompt_tokens, completion_tokens, cost}}
+        """
+        with self.lock:
+            result = {}
+            for role, stats in self.roles.items():
+                result[role] = {
+                    "model": stats["model"],
+                    "calls": stats["calls"],
+                    "avg_latency": round(stats["latency"] / stats["calls"], 2) if stats["calls"] else 0,
+                    "max_latency": round(stats["max_latency"], 2),
+                    "prompt_tokens": stats["prompt_tokens"],
+                    "completion_tokens": stats["completion_tokens"],
+                    "cost": round(stats["cost"], 4),
+                }
+            return result
+
+    def total_cost(self):
+        with self.lock:
+            return sum(stats["cost"] for stats in self.roles.values())
@@ -1,5 +1,4 @@
 from __future__ import annotations
-import datetime
 import logging
 import os
 
@@ -12,7 +11,8 @@ import json
 from datetime import date
 from calendar import monthrange
 
-from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
+from rate_limiter import get_limiter, deployment_config
+from conversation_store import ConversationStore, create_conversation_store
 
 # Models can be found here: https://platform.openai.com/docs/models/overview
 GPT_3_MODELS = ("gpt-3.5-turbo", "gpt-3.5-turbo-0301", "gpt-3.5-turbo-0613")
@@ -131,16 +131,18 @@ class OpenAIHelper:
     ChatGPT helper class.
     """
 
-    def __init__(self, config: dict):
+    def __init__(self, config: dict, store: ConversationStore = None):
         """
         Initializes the OpenAI helper class with the given configuration.
         :param config: A dictionary containing the GPT configuration
+        :param store: The chat histories, by default the one described by config['conversation_store']
         """
         openai.api_key = config['api_key']
         openai.proxy = config['proxy']
         self.config = config
-        self.conversations: dict[int: list] = {}  # {chat_id: history}
-        self.last_updated: dict[int: datetime] = {}  # {chat_id: last_update_timestamp}
+        self.store = store or create_conversation_store(config)  # {chat_id: history and its token counts}
+        self.limiter = get_limiter(config['model'], deployment_config(config.get('rate_limit', {}), config['model']))
+        self.encoding = self.__get_encoding(config['model'])
 
     def get_conversation_stats(self, chat_id: int) -> tuple[int, int]:
         """
@@ -148,9 +150,8 @@ class OpenAIHelper:
         :param chat_id: The chat ID
         :return: A tuple containing the number of messages and tokens used
         """
-        if chat_id not in self.conversations:
-            self.reset_chat_history(chat_id)
-        return len(self.conversations[chat_id]), self.__count_tokens(self.conversations[chat_id])
+        messages, token_counts = self.__get_history(chat_id)
+        return len(messages), self.__count_history_tokens(token_counts)
 
     async def get_chat_response(self, chat_id: int, query: str) -> tuple[str, str]:
         """
@@ -202,19 +203,13 @@ class OpenAIHelper:
                 yield answer, 'not_finished'
         answer = answer.strip()
         self.__add_to_history(chat_id, role="assistant", content=answer)
-        tokens_used = str(self.__count_tokens(self.conversations[chat_id]))
+        tokens_used = str(self.__count_history_tokens(self.__get_history(chat_id)[1]))
 
         if self.config['show_usage']:
             answer += f"\n\n---\n💰 {tokens_used} {localized_text('stats_tokens', self.config['bot_language'])}"
 
         yield answer, tokens_used
 
-    @retry(
-        reraise=True,
-        retry=retry_if_exception_type(openai.error.RateLimitError),
-        wait=wait_fixed(20),
-        stop=stop_after_attempt(3)
-    )
     async def __common_get_chat_response(self, chat_id: int, query: str, stream=False):
         """
         Request a response from the GPT model.
@@ -224,33 +219,35 @@ class OpenAIHelper:
         """
         bot_language = self.config['bot_language']
         try:
-            if chat_id not in self.conversations or self.__max_age_reached(chat_id):
-                self.reset_chat_history(chat_id)
-
-            self.last_updated[chat_id] = datetime.datetime.now()
-
+            # an expired history is reset here
+            self.__get_history(chat_id)
             self.__add_to_history(chat_id, role="user", content=query)
 
             # Summarize the chat history if it's too long to avoid excessive token usage
-            token_count = self.__count_tokens(self.conversations[chat_id])
+            messages, token_counts = self.__get_history(chat_id)
+            token_count = self.__count_history_tokens(token_counts)
             exceeded_max_tokens = token_count + self.config['max_tokens'] > self.__max_model_tokens()
-            exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size']
+            exceeded_max_history_size = len(messages) > self.config['max_history_size']
 
             if exceeded_max_tokens or exceeded_max_history_size:
                 logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
                 try:
-                    summary = await self.__summarise(self.conversations[chat_id][:-1])
+                    summary = await self.__summarise(messages[:-1])
                     logging.debug(f'Summary: {summary}')
-                    self.reset_chat_history(chat_id, self.conversations[chat_id][0]['content'])
+                    self.reset_chat_history(chat_id, messages[0]['content'])
                     self.__add_to_history(chat_id, role="assistant", content=summary)
                     self.__add_to_history(chat_id, role="user", content=query)
                 except Exception as e:
                     logging.warning(f'Error while summarising chat history: {str(e)}. Popping elements instead...')
-                    self.conversations[chat_id] = self.conversations[chat_id][-self.config['max_history_size']:]
+                    self.store.trim(chat_id, self.config['max_history_size'])
+                messages, token_counts = self.__get_history(chat_id)
 
-            return await openai.ChatCompletion.acreate(
+            # the limiter reserves the quota up front and backs off on 429 / 5xx
+            return await self.limiter.acall(
+                openai.ChatCompletion.acreate,
+                self.__count_history_tokens(token_counts) + self.config['max_tokens'],
                 model=self.config['model'],
-                messages=self.conversations[chat_id],
+                messages=messages,
                 temperature=self.config['temperature'],
                 n=self.config['n_choices'],
                 max_tokens=self.config['max_tokens'],
@@ -311,20 +308,20 @@ class OpenAIHelper:
         """
         if content == '':
             content = self.config['assistant_prompt']
-        self.conversations[chat_id] = [{"role": "system", "content": content}]
+        message = {"role": "system", "content": content}
+        self.store.reset(chat_id, message, self.__count_message_tokens(message))
 
-    def __max_age_reached(self, chat_id) -> bool:
+    def __get_history(self, chat_id) -> tuple[list, list]:
         """
-        Checks if the maximum conversation age has been reached.
+        Gets the conversation history, a new one if the chat has none or it reached the maximum age.
         :param chat_id: The chat ID
-        :return: A boolean indicating whether the maximum conversation age has been reached
+        :return: A tuple containing the messages and their token counts
         """
-        if chat_id not in self.last_updated:
-            return False
-        last_updated = self.last_updated[chat_id]
-        now = datetime.datetime.now()
-        max_age_minutes = self.config['max_conversation_age_minutes']
-        return last_updated < now - datetime.timedelta(minutes=max_age_minutes)
+        history = self.store.get(chat_id)
+        if history is None:
+            self.reset_chat_history(chat_id)
+            history = self.store.get(chat_id)
+        return history
 
     def __add_to_history(self, chat_id, role, content):
         """
@@ -333,7 +330,8 @@ class OpenAIHelper:
         :param role: The role of the message sender
         :param content: The message content
         """
-        self.conversations[chat_id].append({"role": role, "content": content})
+        message = {"role": role, "content": content}
+        self.store.append(chat_id, message, self.__count_message_tokens(message))
 
     async def __summarise(self, conversation) -> str:
         """
@@ -345,7 +343,10 @@ class OpenAIHelper:
             {"role": "assistant", "content": "Summarize this conversation in 700 characters or less"},
             {"role": "user", "content": str(conversation)}
         ]
-        response = await openai.ChatCompletion.acreate(
+        # the summary shares the quota of the deployment with the chat requests
+        response = await self.limiter.acall(
+            openai.ChatCompletion.acreate,
+            sum(self.__count_message_tokens(message) for message in messages) + self.config['max_tokens'],
             model=self.config['model'],
             messages=messages,
             temperature=0.4
@@ -366,19 +367,24 @@ class OpenAIHelper:
             f"Max tokens for model {self.config['model']} is not implemented yet."
         )
 
-    # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-    def __count_tokens(self, messages) -> int:
+    @staticmethod
+    def __get_encoding(model):
         """
-        Counts the number of tokens required to send the given messages.
-        :param messages: the messages to send
-        :return: the number of tokens required
+        The tokenizer of the model, loaded once.
         """
-        model = self.config['model']
         try:
-            encoding = tiktoken.encoding_for_model(model)
+            return tiktoken.encoding_for_model(model)
         except KeyError:
-            encoding = tiktoken.get_encoding("gpt-3.5-turbo")
+            return tiktoken.get_encoding("cl100k_base")
 
+    # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+    def __count_message_tokens(self, message) -> int:
+        """
+        Counts the number of tokens of one message, computed once when it is added to the history.
+        :param message: the message
+        :return: the number of tokens required
+        """
+        model = self.config['model']
         if model in GPT_3_MODELS + GPT_3_16K_MODELS:
             tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
             tokens_per_name = -1  # if there's a name, the role is omitted
@@ -387,16 +393,22 @@ class OpenAIHelper:
             tokens_per_name = 1
         else:
             raise NotImplementedError(f"""num_tokens_from_messages() is not implemented for model {model}.""")
-        num_tokens = 0
-        for message in messages:
-            num_tokens += tokens_per_message
-            for key, value in message.items():
-                num_tokens += len(encoding.encode(value))
-                if key == "name":
-                    num_tokens += tokens_per_name
-        num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+        num_tokens = tokens_per_message
+        for key, value in message.items():
+            num_tokens += len(self.encoding.encode(value))
+            if key == "name":
+                num_tokens += tokens_per_name
         return num_tokens
 
+    @staticmethod
+    def __count_history_tokens(token_counts) -> int:
+        """
+        Counts the number of tokens required to send a history, from the cached message counts.
+        :param token_counts: the token counts of the messages of the history
+        :return: the number of tokens required
+        """
+        return sum(token_counts) + 3  # every reply is primed with <|start|>assistant<|message|>
+
     # No longer works as of July 21st 2023, as OpenAI has removed the billing API
     # def get_billing_current_month(self):
     #     """Gets billed usage for current month from OpenAI API.
@@ -435,6 +447,9 @@ if __name__ == "__main__":
         'proxy': os.environ.get('PROXY', None),
         'max_history_size': int(os.environ.get('MAX_HISTORY_SIZE', 15)),
         'max_conversation_age_minutes': int(os.environ.get('MAX_CONVERSATION_AGE_MINUTES', 180)),
+        'conversation_store': os.environ.get('CONVERSATION_STORE', 'memory'),  # memory or redis
+        'redis_info': {'host': os.environ.get('REDIS_HOST', 'localhost'),
+                       'port': int(os.environ.get('REDIS_PORT', 6379))},
         'assistant_prompt': os.environ.get('ASSISTANT_PROMPT', 'You are a helpful assistant.'),
         'max_tokens': int(os.environ.get('MAX_TOKENS', max_tokens_default)),
         'n_choices': int(os.environ.get('N_CHOICES', 1)),
@@ -0,0 +1,395 @@
+import asyncio
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import telegra_ph
+import utils
+from resources import ResourceRegistry
+from transcript import Transcript
+from video_queue import VideoQueue
+
+# default number of workers for each stage, can be overwritten by config['pipeline']
+DEFAULT_STAGE_WORKERS = {
+    "download": 2,
+    "transcribe": 1,  # gpu bound, one or two slots are enough
+    "edit": 8,  # llm bound
+    "summarize": 8,
+    "publish": 4,
+    "notify": 4,
+}
+
+
+@utils.retry(retries=4, delay=1)
+def send_telegram_message(token, chat_id, message):
+    """
+    给 Telegram 用户发送消息。
+
+    :param token: Telegram Bot 的访问 Token。
+    :param chat_id: 接收消息的用户 ID。
+    :param message: 要发送的消息内容。
+    """
+    url = f"https://api.telegram.org/bot{token}/sendMessage"
+    params = {"chat_id": chat_id, "text": message, 'parse_mode': 'HTML'}
+
+    response = utils.get_http_responce(url, 'POST', params)
+
+    if response.status != 200:
+        print(
+            f"Error: telegram message sent failed! status_code={response.status}, text={response.data}")
+        print("message:\n", message)
+        raise Exception("Error: telegram message sent failed!")
+    return response
+
+
+async def cancel_tasks(tasks):
+    """
+    Cancel the tasks and wait for them, so that their errors are retrieved instead of logged as never retrieved.
+    """
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def video_message(video0):
+    return f'<b>{video0["channel_name"]}\n</b>' \
+           + f'<u>{video0["title"]}\n</u>' \
+           + f'👉<a href=\"{video0["srt_url"]}\" >字幕(subtitle)</a>' \
+           + f'👉<a href=\"{video0["edit_url"]}\">全文(fulltext)</a>\n' \
+           + video0["result"]
+
+
+class VideoJob:
+    """
+    A video travelling through the pipeline, every stage fills in its own fields.
+    """
+
+    def __init__(self, video, priority=False):
+        self.video = video
+        self.priority = priority
+        self.srt = None
+        self.srt_source = None  # manual, auto or whisper, see transcript_cache
+        self.audio = None  # 16 kHz samples or path of the audio file, only for videos without captions
+        self.paragraphs = None
+        self.keypoints = None  # per segment, only in single pass mode
+        self.edit_tasks = None  # streaming transcription: edit requests started while the audio was transcribed
+        self.result = None
+        self.srt_url = None
+        self.edit_url = None
+        self.tg_message = None
+        loop = asyncio.get_running_loop()
+        # resolved with the telegram message once the video is summarized (None if that failed),
+        # the other subscribers of the same video wait on it
+        self.summarized: asyncio.Future = loop.create_future()
+        # resolved with True once the user has been notified, False if the job failed
+        self.done: asyncio.Future = loop.create_future()
+
+    def set_summarized(self):
+        if not self.summarized.done():
+            self.summarized.set_result(self.tg_message)
+
+    def finish(self, sent):
+        if not self.summarized.done():
+            self.summarized.set_result(self.tg_message if sent else None)
+        if not self.done.done():
+            self.done.set_result(sent)
+
+
+class Stage:
+    """
+    A pipeline stage: `workers` coroutines reading jobs from a bounded queue.
+
+    The handler returns the next stage of the job (or None when the job is finished). Putting the job into the
+    next (bounded) queue blocks while that stage is busy, which is how backpressure propagates upstream.
+    """
+
+    def __init__(self, name, handler, workers, queue_size, retries=1):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.retries = retries
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.worker(i)) for i in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def put(self, job: VideoJob):
+        await self.queue.put(job)
+
+    async def worker(self, index):
+        while True:
+            job = await self.queue.get()
+            next_stage = None
+            try:
+                next_stage = await self.run_handler(job)
+            except Exception as e:
+                print(f"{self.name}-{index}: video {job.video.get('link')} failed: {repr(e)}")
+                job.finish(False)
+            finally:
+                self.queue.task_done()
+
+            if next_stage is not None:
+                await next_stage.put(job)
+            else:
+                job.finish(job.tg_message is not None)
+
+    async def run_handler(self, job):
+        for i in range(1, self.retries + 1):
+            try:
+                return await self.handler(job)
+            except Exception as e:
+                if i == self.retries:
+                    raise
+                print(f"{self.name}: {repr(e)} -> Retrying...")
+                await asyncio.sleep(1)
+
+
+class VideoPipeline:
+    """
+    download -> transcribe -> edit -> summarize -> publish -> notify
+
+    Every stage has its own concurrency, so the gpu can transcribe video N+1 while the llm summarizes video N.
+    """
+
+    def __init__(self, conn, config, resources: ResourceRegistry, video_queue: VideoQueue = None):
+        self.conn = conn
+        self.config = config
+        self.resources = resources
+        self.video_queue = video_queue  # used to claim videos across summarizer nodes
+        self.downloader = resources.downloader
+        self.srt_summarize = resources.srt_summarize
+        self.transcripts = resources.transcripts
+
+        pipeline_config = config.get('pipeline', {})
+        queue_size = pipeline_config.get('queue_size', 2)
+        workers = {name: pipeline_config.get(name, n) for name, n in DEFAULT_STAGE_WORKERS.items()}
+
+        self.download_stage = Stage("download", self.download, workers["download"], queue_size, retries=2)
+        self.transcribe_stage = Stage("transcribe", self.transcribe, workers["transcribe"], queue_size, retries=2)
+        self.edit_stage = Stage("edit", self.edit, workers["edit"], queue_size, retries=2)
+        self.summarize_stage = Stage("summarize", self.summarize, workers["summarize"], queue_size, retries=2)
+        self.publish_stage = Stage("publish", self.publish, workers["publish"], queue_size, retries=2)
+        self.notify_stage = Stage("notify", self.notify, workers["notify"], queue_size)
+        self.stages = [self.download_stage, self.transcribe_stage, self.edit_stage, self.summarize_stage,
+                       self.publish_stage, self.notify_stage]
+
+        # send every segment to the llm as soon as it is transcribed, instead of after the whole audio
+        self.stream_transcription = pipeline_config.get('stream_transcription', False)
+
+        # upper bound of videos inside the pipeline, submit() waits when it is reached
+        self.in_flight = asyncio.Semaphore(config.get('summarizer', {}).get('max_concurrent_videos', 8))
+        # {video_url: job} of the videos being summarized in this process, one job per video
+        self.summarizing = {}
+
+    def start(self):
+        # every worker may sit in a blocking call, make sure the executor never starves a stage
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=sum(stage.workers for stage in self.stages)))
+        for stage in self.stages:
+            stage.start()
+
+    async def stop(self):
+        for stage in self.stages:
+            await stage.stop()
+
+    async def submit(self, video, priority=False) -> VideoJob:
+        job = VideoJob(video, priority)
+        await self.start_job(job)
+        return job
+
+    async def start_job(self, job: VideoJob):
+        """
+        Single flight: only the first job of a video runs download .. publish, the jobs of the other
+        subscribers wait for its result and only go through the notify stage.
+        """
+        link = job.video["link"]
+        if link in self.summarizing:
+            asyncio.create_task(self.follow(job, self.summarizing[link]))
+            return
+
+        await self.in_flight.acquire()
+        if link in self.summarizing:  # registered while we were waiting for a slot
+            self.in_flight.release()
+            asyncio.create_task(self.follow(job, self.summarizing[link]))
+            return
+        if self.video_queue is not None and not self.video_queue.claim_video(link):
+            self.in_flight.release()
+            print(f"video {link} is summarized by another worker, waiting for it")
+            asyncio.create_task(self.wait_other_worker(job))
+            return
+
+        self.summarizing[link] = job
+        job.summarized.add_done_callback(lambda _: self.release_video(link))
+        job.done.add_done_callback(lambda _: self.release_audio(job))
+        job.done.add_done_callback(lambda _: self.in_flight.release())
+        await self.download_stage.put(job)
+
+    def release_audio(self, job: VideoJob):
+        if job.audio is not None:
+            self.downloader.cleanup(job.audio)
+            job.audio = None
+
+    def release_video(self, link):
+        self.summarizing.pop(link, None)
+        if self.video_queue is not None:
+            self.video_queue.release_video(link)
+
+    async def follow(self, job: VideoJob, leader: VideoJob):
+        print(f"video {job.video['link']} is already being summarized, waiting for it")
+        job.tg_message = await asyncio.shield(leader.summarized)
+        if job.tg_message is None:
+            job.finish(False)
+            return
+        await self.notify_stage.put(job)
+
+    async def wait_other_worker(self, job: VideoJob):
+        link = job.video["link"]
+        while self.video_queue.video_claimed(link):
+            await asyncio.sleep(10)
+        video0 = self.conn.select_data_from_database("video", video_url=link)
+        if video0:
+            job.tg_message = video_message(video0[0])
+            await self.notify_stage.put(job)
+        else:  # the other worker failed, try it here
+            await self.start_job(job)
+
+    async def download(self, job: VideoJob):
+        video = job.video
+        video0 = self.conn.select_data_from_database("video", video_url=video["link"])
+        if video0:  # already summarized, only notify the user
+            job.tg_message = video_message(video0[0])
+            job.set_summarized()
+            return self.notify_stage
+
+        ## a retried video reuses its transcript instead of downloading and transcribing it again
+        job.srt, job.srt_source = await utils.run_blocking(self.transcripts.get, video["link"])
+        if job.srt is not None:
+            print(f"{job.srt_source} transcript of video {video['link']} found in the cache")
+            return self.edit_stage
+
+        job.srt, job.srt_source, job.audio = await utils.run_blocking(self.downloader.fetch, video["link"])
+        if job.srt is not None:
+            await utils.run_blocking(self.transcripts.put, video["link"], job.srt_source, job.srt)
+            return self.edit_stage
+        if job.audio is not None:
+            return self.transcribe_stage
+        raise ValueError(f"Subtitles could not be retrieved for video: {video['link']}")
+
+    async def transcribe(self, job: VideoJob):
+        if self.stream_transcription:
+            await self.transcribe_and_edit(job)
+        else:
+            job.srt = await utils.run_blocking(self.transcribe_audio, job.audio)
+        job.srt_source = "whisper"
+        self.release_audio(job)  # the disk space / memory is given back before the llm stages
+        await utils.run_blocking(self.transcripts.put, job.video["link"], job.srt_source, job.srt)
+        return self.edit_stage
+
+    def transcribe_audio(self, audio):
+        with self.resources.whisper() as audio2text_tool:
+            return audio2text_tool.process(audio)
+
+    def stream_audio(self, audio):
+        with self.resources.whisper() as audio2text_tool:
+            yield from audio2text_tool.stream(audio)
+
+    async def transcribe_and_edit(self, job: VideoJob):
+        """
+        Streaming mode: every segment goes to the llm as soon as it is transcribed, so the edit requests
+        overlap the rest of the transcription. The edit stage only waits for their replies.
+        """
+        single_pass = self.config['openai'].get('single_pass')
+        segmenter = self.srt_summarize.streaming_segmenter("editor_summerizer" if single_pass else "editor")
+        edit_segment = self.srt_summarize.aedit_summarize_segment if single_pass else self.srt_summarize.aedit_segment
+        rows = []
+        edit_tasks = []
+        try:
+            # closed as soon as this fails or is cancelled, which stops whisper and releases the model
+            async with contextlib.aclosing(utils.iterate_blocking(self.stream_audio, job.audio)) as stream:
+                async for row in stream:
+                    rows.append(row)
+                    for segment in segmenter.feed(*row):
+                        edit_tasks.append(asyncio.create_task(edit_segment(segment[1])))
+            for segment in segmenter.flush():
+                edit_tasks.append(asyncio.create_task(edit_segment(segment[1])))
+        except BaseException:
+            await cancel_tasks(edit_tasks)
+            raise
+        job.srt = Transcript.from_rows(rows)
+        job.edit_tasks = edit_tasks
+
+    async def edit(self, job: VideoJob):
+        if job.edit_tasks:
+            edit_tasks, job.edit_tasks = job.edit_tasks, None  # a retry edits the whole transcript again
+            try:
+                results = await asyncio.gather(*edit_tasks)
+            except BaseException:  # the other segments are not needed anymore
+                await cancel_tasks(edit_tasks)
+                raise
+            if self.config['openai'].get('single_pass'):
+                job.paragraphs, job.keypoints = [text for text, _ in results], [keypoints for _, keypoints in results]
+            else:
+                job.paragraphs = list(results)
+        elif self.config['openai'].get('single_pass'):
+            job.paragraphs, job.keypoints = await self.srt_summarize.aedit_and_summarize(job.srt)
+        else:
+            job.paragraphs = await self.srt_summarize.aedit(job.srt)
+        return self.summarize_stage
+
+    async def summarize(self, job: VideoJob):
+        if job.keypoints is not None:  # single pass mode, only the merge is left
+            job.result = await self.srt_summarize.areduce_keypoints(job.keypoints)
+        else:
+            job.result = await self.srt_summarize.asummarize(job.paragraphs)
+        if not job.result:
+            raise ValueError(f"Empty summary for video: {job.video['link']}")
+        return self.publish_stage
+
+    async def publish(self, job: VideoJob):
+        video = job.video
+        access_token = self.config["telegra.ph"]["access_token"]
+        if job.srt_url is None:
+            job.srt_url = (await utils.run_blocking(telegra_ph.publish_srt_to_telegraph,
+                                                    access_token, video["title"], job.srt))[0]
+        job.edit_url = (await utils.run_blocking(telegra_ph.publish2telegraph,
+                                                 access_token, video["title"], job.paragraphs))[0]
+
+        if not self.conn.select_data_from_database("video", video_url=video['link']):
+            self.conn.insert_data_to_database("video", video_url=video['link'], channel_name=video['channel_name'],
+                                              title=video['title'], srt_url=job.srt_url, edit_url=job.edit_url,
+                                              result=job.result)
+
+        job.tg_message = video_message({"channel_name": video["channel_name"], "title": video["title"],
+                                        "srt_url": job.srt_url, "edit_url": job.edit_url, "result": job.result})
+        job.set_summarized()  # the other subscribers can be notified from now on
+        return self.notify_stage
+
+    async def notify(self, job: VideoJob):
+        video = job.video
+        if not job.priority and not self.conn.select_data_from_database("channel_video",
+                                                                        channel_url=video["channel_url"],
+                                                                        video_link=video["link"]):
+            self.conn.insert_data_to_database("channel_video", channel_url=video["channel_url"],
+                                              channel_name=video["channel_name"],
+                                              video_link=video["link"])
+
+        if not self.conn.select_data_from_database("user_video", tg_user_id=video["tg_user_id"],
+                                                   video_link=video["link"]):
+            self.conn.insert_data_to_database("user_video", tg_user_id=video["tg_user_id"], video_link=video["link"],
+                                              title=video["title"])
+
+        res = await utils.run_blocking(send_telegram_message, self.config["telegram_bot"]["token"],
+                                       video["tg_user_id"], job.tg_message)
+        if res is None or res.status != 200:
+            raise ValueError(f"telegram message sent failed! video={video['title']}, user={video['tg_user_id']}")
+
+        print(f"video {video['title']} summarized and sent to user {video['tg_user_id']}!")
+        if self.srt_summarize.cache is not None:
+            print("llm cache:", self.srt_summarize.cache.stats())
+        print("llm usage:", self.srt_summarize.usage.stats())
+        return None
@@ -0,0 +1,253 @@
+import asyncio
+import collections
+import random
+import threading
+import time
+import openai
+
+# errors worth another attempt: throttling, server side errors and network problems
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+)
+
+
+class TokenBucket:
+    """
+    Refills `per_minute` units per minute. reserve() always succeeds and may drive the level negative,
+    the caller then waits until the reservation is covered, so waiting callers are served in order.
+    """
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def reserve(self, amount):
+        """
+        :return: seconds to wait before the reserved amount is available
+        """
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= min(amount, self.capacity)
+        return 0 if self.level >= 0 else -self.level / self.rate
+
+    def refund(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+
+class SlotWaiter:
+    """
+    A caller waiting for a concurrency slot. `wake` is called (under the limiter lock) once the slot is granted.
+    """
+    __slots__ = ("wake", "granted")
+
+    def __init__(self, wake):
+        self.wake = wake
+        self.granted = False
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AdaptiveRateLimiter:
+    """
+    Shared limiter for the calls to one OpenAI deployment.
+
+    - every request reserves one request and its estimated tokens in the RPM / TPM buckets before it starts,
+      the estimate is corrected with the real usage afterwards
+    - 429 and 5xx errors are retried after an exponential backoff with jitter (or the retry-after header)
+    - the number of concurrent requests is halved when throttled and grows back by one per window of
+      successful requests (AIMD). Callers waiting for a slot sleep until a slot is handed to them, first come
+      first served; the async and the blocking callers share the same queue.
+    """
+
+    def __init__(self, rpm=0, tpm=0, max_concurrency=8, min_concurrency=1, max_retries=5, base_delay=1,
+                 max_delay=60):
+        self.lock = threading.Lock()
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.waiters = collections.deque()  # SlotWaiter, in arrival order
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.last_throttled = 0
+
+    def _take_slot(self, wake):
+        """
+        :return: None if a concurrency slot was taken, otherwise the SlotWaiter queued for the next free slot
+        """
+        with self.lock:
+            if not self.waiters and self.in_flight < int(self.concurrency):
+                self.in_flight += 1
+                return None
+            waiter = SlotWaiter(wake)
+            self.waiters.append(waiter)
+            return waiter
+
+    def _wake_waiters(self):
+        """
+        Hand the free slots to the first waiters, the lock must be held.
+        """
+        while self.waiters and self.in_flight < int(self.concurrency):
+            waiter = self.waiters.popleft()
+            waiter.granted = True
+            self.in_flight += 1
+            waiter.wake()
+
+    def _cancel_wait(self, waiter):
+        with self.lock:
+            if waiter.granted:  # the slot came too late, give it to the next one
+                self.in_flight -= 1
+                self._wake_waiters()
+            else:
+                self.waiters.remove(waiter)
+
+    async def _aslot(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = self._take_slot(lambda: loop.call_soon_threadsafe(_resolve, future))
+        if waiter is None:
+            return
+        try:
+            await future
+        except BaseException:
+            self._cancel_wait(waiter)
+            raise
+
+    def _slot(self):
+        event = threading.Event()
+        if self._take_slot(event.set) is not None:
+            event.wait()
+
+    def _reserve(self, estimated_tokens):
+        """
+        :return: the seconds to wait for the RPM / TPM quota
+        """
+        with self.lock:
+            wait = 0
+            if self.requests is not None:
+                wait = self.requests.reserve(1)
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.reserve(estimated_tokens))
+            return wait
+
+    def _leave(self, estimated_tokens, used_tokens=None, throttled=False):
+        """
+        :param used_tokens: tokens of the response, 0 for a failed request (its whole estimate is refunded),
+                            None if the response did not report its usage (the estimate is kept)
+        """
+        with self.lock:
+            self.in_flight -= 1
+            if used_tokens is not None and self.tokens is not None:
+                self.tokens.refund(estimated_tokens - used_tokens)
+            if throttled:
+                # one decrease per burst of 429s, the requests in flight all fail at about the same time
+                if time.monotonic() - self.last_throttled > 1:
+                    self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+                    print(f"rate limited, concurrency reduced to {int(self.concurrency)}")
+                self.last_throttled = time.monotonic()
+            else:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self._wake_waiters()
+
+    def backoff(self, attempt, error=None):
+        retry_after = getattr(error, 'headers', None) and error.headers.get('retry-after')
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+    @staticmethod
+    def used_tokens(response):
+        usage = response.get('usage') if isinstance(response, dict) else None
+        return usage['total_tokens'] if usage else None
+
+    async def acall(self, func, estimated_tokens, **kwargs):
+        """
+        Await func(**kwargs) within the limits, retrying retryable errors. The last error is raised.
+        """
+        for attempt in range(self.max_retries):
+            await self._aslot()
+            try:
+                await asyncio.sleep(self._reserve(estimated_tokens))
+                response = await func(**kwargs)
+            except RETRYABLE_ERRORS as e:
+                self._leave(estimated_tokens, 0, throttled=isinstance(e, openai.error.RateLimitError))
+                if attempt == self.max_retries - 1:
+                    raise
+                delay = self.backoff(attempt, e)
+                print(f"{repr(e)} -> retrying in {delay:.1f} seconds ...")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                self._leave(estimated_tokens, 0)
+                raise
+            self._leave(estimated_tokens, self.used_tokens(response))
+            return response
+
+    def call(self, func, estimated_tokens, **kwargs):
+        """
+        Blocking twin of acall(), for the synchronous callers.
+        """
+        for attempt in range(self.max_retries):
+            self._slot()
+            try:
+                time.sleep(self._reserve(estimated_tokens))
+                response = func(**kwargs)
+            except RETRYABLE_ERRORS as e:
+                self._leave(estimated_tokens, 0, throttled=isinstance(e, openai.error.RateLimitError))
+                if attempt == self.max_retries - 1:
+                    raise
+                delay = self.backoff(attempt, e)
+                print(f"{repr(e)} -> retrying in {delay:.1f} seconds ...")
+                time.sleep(delay)
+                continue
+            except BaseException:
+                self._leave(estimated_tokens, 0)
+                raise
+            self._leave(estimated_tokens, self.used_tokens(response))
+            return response
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def deployment_config(rate_limit, model):
+    """
+    Limits of one deployment, from a rate_limit config section: its plain keys ({"rpm", "tpm", ...}) are the
+    defaults, and a nested section named after the model overrides them, e.g. {"rpm": 300, "gpt-4": {"rpm": 60}}.
+    This is the only place the limits of a deployment come from, whichever role or helper calls it.
+    """
+    defaults = {key: value for key, value in rate_limit.items() if not isinstance(value, dict)}
+    return {**defaults, **rate_limit.get(model, {})}
+
+
+def get_limiter(name, config) -> AdaptiveRateLimiter:
+    """
+    The process-wide limiter of a deployment, created from `config` ({"rpm", "tpm", "max_concurrency", ...})
+    on first use. All the callers of the same deployment share its quota.
+    """
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = AdaptiveRateLimiter(
+                rpm=config.get('rpm', 0),
+                tpm=config.get('tpm', 0),
+                max_concurrency=config.get('max_concurrency', 8),
+                max_retries=config.get('max_retries', 5),
+                max_delay=config.get('max_delay', 60))
+        return _limiters[name]
@@ -0,0 +1,101 @@
+import asyncio
+import gc
+import threading
+import time
+from contextlib import contextmanager
+from whisper_helper import audio2text
+from youtube2srt import SubtitleDownloader
+from captions import CaptionResolver
+from summarizer import SrtSummarizer
+from llm_cache import create_llm_cache
+from transcript_cache import TranscriptCache
+
+
+class ResourceRegistry:
+    """
+    Process-wide holder of the expensive objects of the summarizer.
+
+    The downloader, the summarizer and the transcript cache are created once. The whisper model is only loaded when a video
+    without subtitles has to be transcribed, and unloaded again after `idle_unload_seconds` without use,
+    so the memory is released between bursts of videos.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self._downloader = None
+        self._srt_summarize = None
+        self._transcripts = None
+        self._audio2text = None
+        self.whisper_users = 0
+        self.whisper_last_used = 0
+        self.idle_unload_seconds = config['faster_whisper'].get('idle_unload_seconds', 600)
+
+    @property
+    def downloader(self) -> SubtitleDownloader:
+        with self.lock:
+            if self._downloader is None:
+                caption_resolver = CaptionResolver.from_config(self.config.get('captions', {}))
+                self._downloader = SubtitleDownloader(self.config['youtube_dl'], caption_resolver=caption_resolver)
+            return self._downloader
+
+    @property
+    def srt_summarize(self) -> SrtSummarizer:
+        with self.lock:
+            if self._srt_summarize is None:
+                self._srt_summarize = SrtSummarizer(self.config["openai"], create_llm_cache(self.config))
+            return self._srt_summarize
+
+    @property
+    def transcripts(self) -> TranscriptCache:
+        with self.lock:
+            if self._transcripts is None:
+                cache_config = self.config.get('transcript_cache', {})
+                self._transcripts = TranscriptCache(cache_config.get('path', 'transcripts'),
+                                                    cache_config.get('ttl_days', 30))
+            return self._transcripts
+
+    @contextmanager
+    def whisper(self):
+        """
+        Borrow the whisper model, loading it on first use. It is never unloaded while borrowed.
+        """
+        with self.lock:
+            if self._audio2text is None:
+                print("loading whisper model")
+                self._audio2text = audio2text.from_config(self.config['faster_whisper'])  # gpu, or cpu int8
+            self.whisper_users += 1
+            tool = self._audio2text
+        try:
+            yield tool
+        finally:
+            with self.lock:
+                self.whisper_users -= 1
+                self.whisper_last_used = time.time()
+
+    def unload_idle(self):
+        with self.lock:
+            if self._audio2text is None or self.whisper_users > 0:
+                return False
+            if time.time() - self.whisper_last_used < self.idle_unload_seconds:
+                return False
+            print("whisper model idle, unloading it")
+            self._audio2text.close()
+            self._audio2text = None
+        gc.collect()
+        return True
+
+    async def unload_idle_task(self):
+        while True:
+            await asyncio.sleep(min(60, self.idle_unload_seconds))
+            self.unload_idle()
+
+
+_registry = None
+
+
+def get_resources(config) -> ResourceRegistry:
+    global _registry
+    if _registry is None:
+        _registry = ResourceRegistry(config)
+    return _registry
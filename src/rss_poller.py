@@ -0,0 +1,130 @@
+import asyncio
+import heapq
+import json
+import os
+import aiohttp
+import redis
+import utils
+
+
+class RssPoller:
+    """
+    Fetch rsshub feeds concurrently, each feed once per round however many users follow it.
+
+    The ETag / Last-Modified of every feed are kept in redis and sent back as If-None-Match /
+    If-Modified-Since, an unchanged feed answers 304 and is not downloaded nor parsed again.
+    """
+
+    def __init__(self, redis_client: redis.Redis, config):
+        rsshub_config = config.get('rsshub', {})
+        self.redis_client = redis_client
+        self.base_url = rsshub_config.get('base_url', "https://rsshub.app/")
+        self.max_connections = rsshub_config.get('max_connections', 10)
+        self.timeout = rsshub_config.get('timeout', 60)
+        self.validators_key = "rss_validators"  # {channel_url: {"etag": ..., "last_modified": ...}}
+
+    async def fetch_all(self, channel_urls):
+        """
+        :return: {channel_url: (data, validators)} for the feeds that changed, data is the parsed json feed
+        """
+        stored = self.redis_client.hmget(self.validators_key, channel_urls) if channel_urls else []
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            results = await asyncio.gather(*(self.fetch(session, channel_url, json.loads(validators or '{}'))
+                                             for channel_url, validators in zip(channel_urls, stored)))
+        return {channel_url: result for channel_url, result in zip(channel_urls, results) if result is not None}
+
+    # 访问 rsshub 并解析 json，多次尝试，避免因网络请求不稳定而产生的问题
+    @utils.retry(retries=4, delay=1)
+    async def fetch(self, session: aiohttp.ClientSession, channel_url, validators):
+        headers = {}
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+        url = self.base_url + channel_url + "?format=json"
+        async with session.get(url, headers=headers, proxy=os.environ.get("HTTPS_PROXY")) as res:
+            if res.status == 304:  # feed not changed since the last poll
+                return None
+            res.raise_for_status()
+            data = json.loads(await res.read())
+            return data, {"etag": res.headers.get("ETag"), "last_modified": res.headers.get("Last-Modified")}
+
+    def save_validators(self, channel_url, validators):
+        """
+        Remember the validators of a feed, only once its new videos have been queued.
+        """
+        if validators.get("etag") or validators.get("last_modified"):
+            self.redis_client.hset(self.validators_key, channel_url, json.dumps(validators))
+
+
+class PollScheduler:
+    """
+    Decide when every channel is polled next, from its own upload cadence.
+
+    The average gap between the last uploads (feed pubDates and newest_video_time) is divided by
+    `cadence_divisor` and clamped to [min_interval, max_interval]: a daily uploader is polled every
+    ~1 hour by default, a channel posting twice a year only every `max_interval`. The next poll times
+    are kept in a heap, so finding the due channels is O(log n) per channel.
+    """
+
+    def __init__(self, config):
+        rsshub_config = config.get('rsshub', {})
+        self.min_interval = rsshub_config.get('min_poll_interval', 60 * 3)
+        # must stay below one day, only videos published in the last day are queued
+        self.max_interval = rsshub_config.get('max_poll_interval', 3600 * 6)
+        self.cadence_divisor = rsshub_config.get('cadence_divisor', 20)
+        self.max_history = 10
+        self.heap = []  # [(next_poll_time, channel_url)], entries not matching next_poll are stale
+        self.next_poll = {}  # {channel_url: next_poll_time}
+        self.pub_dates = {}  # {channel_url: sorted recent upload timestamps}
+
+    def sync(self, channel_urls, now):
+        """
+        Follow the current subscriptions: new channels are polled right away, removed ones are forgotten.
+        """
+        channel_urls = set(channel_urls)
+        for channel_url in channel_urls - self.next_poll.keys():
+            self.schedule(channel_url, now)
+        for channel_url in self.next_poll.keys() - channel_urls:
+            del self.next_poll[channel_url]
+            self.pub_dates.pop(channel_url, None)
+
+    def schedule(self, channel_url, t):
+        self.next_poll[channel_url] = t
+        heapq.heappush(self.heap, (t, channel_url))
+
+    def due(self, now):
+        result = []
+        while self.heap and self.heap[0][0] <= now:
+            t, channel_url = heapq.heappop(self.heap)
+            if self.next_poll.get(channel_url) == t:
+                result.append(channel_url)
+        return result
+
+    def seconds_until_next(self, now):
+        while self.heap and self.next_poll.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)  # drop stale entries
+        if not self.heap:
+            return self.min_interval
+        return max(0, self.heap[0][0] - now)
+
+    def interval(self, channel_url, now):
+        pub_dates = self.pub_dates.get(channel_url, [])
+        if not pub_dates:
+            return self.max_interval
+        gap = (pub_dates[-1] - pub_dates[0]) / (len(pub_dates) - 1) if len(pub_dates) > 1 else 0
+        # a channel silent for much longer than its usual gap has probably slowed down
+        gap = max(gap, (now - pub_dates[-1]) / 2)
+        return min(self.max_interval, max(self.min_interval, gap / self.cadence_divisor))
+
+    def reschedule(self, channel_url, pub_dates, now):
+        """
+        :param pub_dates: upload timestamps seen in this poll (may be empty, e.g. the feed answered 304)
+        """
+        known = set(self.pub_dates.get(channel_url, []))
+        known.update(t for t in pub_dates if t)
+        self.pub_dates[channel_url] = sorted(known)[-self.max_history:]
+        self.schedule(channel_url, now + self.interval(channel_url, now))
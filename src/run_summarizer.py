@@ -2,6 +2,7 @@ import json
 
 import redis
 from summarizer_helper import video_pool_update_task, video_summerizer_task
+from video_queue import VideoQueue
 import asyncio
 import time
 
@@ -34,7 +35,12 @@ async def main():
     redis_client = redis.Redis(
         host=config['redis_info']['host'], port=config['redis_info']['port'], decode_responses=True)
     # redis_client.flushdb()
-    video_pool_name = "video_pool"
+    summarizer_config = config.get("summarizer", {})
+    video_queue = VideoQueue(redis_client, "video_pool", consumer=summarizer_config.get("consumer_name"),
+                             lease_timeout=summarizer_config.get("lease_timeout", 600),
+                             max_deliveries=summarizer_config.get("max_deliveries", 3))
+    video_queue.ensure_group()
+    video_queue.migrate_legacy_pool()  # one-shot, does nothing once the old hash is gone
 
     os.environ["HTTP_PROXY"] = config["proxies"]["http"]
     os.environ["HTTPS_PROXY"] = config["proxies"]["https"]
@@ -42,10 +48,10 @@ async def main():
 
     # 1. video pool update task
     task0 = asyncio.create_task(
-        video_pool_update_task(60 * 3, config, redis_client, video_pool_name))  # update video pool every half hour
+        video_pool_update_task(60 * 3, config, video_queue))  # channels are polled on their own schedule, checked at least every 3 minutes
 
     task1 = asyncio.create_task(video_summerizer_task(
-        config, redis_client, video_pool_name))
+        config, video_queue))
 
     await asyncio.gather(task0, task1)
 
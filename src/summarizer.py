@@ -1,8 +1,13 @@
 import openai
-import pandas as pd
+import numpy as np
 import tiktoken 
 import os
-import traceback
+import json
+import asyncio
+import time
+from rate_limiter import get_limiter, deployment_config
+from llm_usage import LLMUsage
+import utils
 
 # def estimate_token_count(text, model):
 #     encoding = tiktoken.encoding_for_model(model)
@@ -10,16 +15,55 @@ import traceback
 
 
 class SrtSummarizer:
-    def __init__(self, config ):
+    def __init__(self, config, cache=None):
 
         self.init_openai(config)
 
         self.max_token_count = config["max_tokens"]    
         self.model=config["model"] 
         
-        self.encoding = self.init_encoding(config["model"])
+        self.encodings = {}
+        self.warned_models = set()  # generic model names, warned about once
+        self.encoding = self.get_encoding(config["model"])
 
         self.config=config
+        ## every role (editor, summerizer, merger, ...) may be routed to its own model
+        self.roles = {name: self.init_role(name) for name in [*config["roles"], "merger"]}
+        # rpm / tpm quota of the deployment, shared by every role and summarizer of the process using it,
+        # so it is configured per model (openai.rate_limit.<model>), not per role
+        self.limiters = {name: get_limiter(role["model"], self.limiter_config(role["model"]))
+                         for name, role in self.roles.items()}
+        self.role_slots = {name: asyncio.Semaphore(role["max_concurrency"]) for name, role in self.roles.items()}
+        self.max_merge_rounds = config.get("max_merge_rounds", 4)  # rounds of the keypoint map-reduce
+        self.cache = cache  # llm_cache.LLMCache, replies of identical requests are reused
+        self.usage = LLMUsage()  # latency, tokens and cost per role
+
+    def init_role(self, name):
+        """
+        Settings of a role: prompt, temperature, model, max_tokens, max_concurrency and price.
+        The ones missing in the role are taken from the openai section, the merger (final merge of the
+        keypoints) falls back to the summerizer. max_concurrency only limits the requests of this role,
+        the rate limit of its model is set in openai.rate_limit.
+        """
+        roles = self.config["roles"]
+        role = dict(roles.get("summerizer", {})) if name == "merger" else {}
+        role.update(roles.get(name, {}))
+        role.setdefault("model", self.config["model"])
+        role.setdefault("max_tokens", self.config["max_tokens"])
+        role.setdefault("max_concurrency", self.config.get("max_concurrency", 8))
+        role.setdefault("price", self.config.get("price", {}))
+        if "rate_limit" in roles.get(name, {}):
+            print(f"Warning: openai.roles.{name}.rate_limit is ignored, "
+                  f"set openai.rate_limit.{role['model']} instead, it is shared by all the roles of this model")
+        return role
+
+    def limiter_config(self, model):
+        """
+        openai.rate_limit, with the overrides of the model; max_concurrency defaults to openai.max_concurrency.
+        """
+        return {"max_concurrency": self.config.get("max_concurrency", 8),
+                **deployment_config(self.config.get("rate_limit", {}), model)}
+
     def init_openai(self, config):
         openai.api_key = config["key"]
         if config["api_base_url"]:
@@ -28,6 +72,8 @@ class SrtSummarizer:
             openai.api_type = config['api_type']
         if config['api_version']:
             openai.api_version = config['api_version']
+        if os.environ.get("HTTPS_PROXY"):
+            openai.proxy = os.environ["HTTPS_PROXY"]  # the async client (aiohttp) ignores the proxy env variables
 
     def init_encoding(self, model):
         try:
@@ -37,14 +83,26 @@ class SrtSummarizer:
             encoding = tiktoken.get_encoding("cl100k_base")
         return encoding
 
-    def estimate_token_count(self, text):
+    def get_encoding(self, model):
+        if model not in self.encodings:
+            self.encodings[model] = self.init_encoding(model)
+        return self.encodings[model]
+
+    def estimate_token_count(self, text, model=None):
 
-        return len(self.encoding.encode(text))   
+        return len(self.get_encoding(model or self.model).encode(text))   
 
-    def estimate_tokens_from_messages(self, messages):   
+    def warn_model(self, model, message):
+        # every request is estimated, print it once per model
+        if model not in self.warned_models:
+            self.warned_models.add(model)
+            print(message)
+
+    def estimate_tokens_from_messages(self, messages, model=None):   
         # source: https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
         """Return the number of tokens used by a list of messages."""
-        model=self.config["model"]
+        model=model or self.model
+        encoding = self.get_encoding(model)
         
         if model in {
             "gpt-3.5-turbo-0613",
@@ -61,11 +119,11 @@ class SrtSummarizer:
             tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
             tokens_per_name = -1  # if there's a name, the role is omitted
         elif "gpt-3.5-turbo" in model:
-            print("Warning: gpt-3.5-turbo may update over time. Returning num tokens assuming gpt-3.5-turbo-0613.")
+            self.warn_model(model, "Warning: gpt-3.5-turbo may update over time. Returning num tokens assuming gpt-3.5-turbo-0613.")
             tokens_per_message = 3
             tokens_per_name = 1
         elif "gpt-4" in model:
-            print("Warning: gpt-4 may update over time. Returning num tokens assuming gpt-4-0613.")
+            self.warn_model(model, "Warning: gpt-4 may update over time. Returning num tokens assuming gpt-4-0613.")
             tokens_per_message = 3
             tokens_per_name = 1
         else:
@@ -76,7 +134,7 @@ class SrtSummarizer:
         for message in messages:
             num_tokens += tokens_per_message
             for key, value in message.items():
-                num_tokens += len(self.encoding.encode(value))
+                num_tokens += len(encoding.encode(value))
                 if key == "name":
                     num_tokens += tokens_per_name
         num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
@@ -84,72 +142,148 @@ class SrtSummarizer:
         return num_tokens
 
 
-    def split_srt(self, srt):
-        ## srt to segmentation
-        token_count = self.max_token_count / 3  ## split srt into segments with 1000 tokens
-        tmp = 0
-        tmp_str = ''
+    def split_srt(self, srt, role="editor"):
+        ## srt to segmentation, sized for the model of the role the segments are sent to
+        token_count = self.roles[role]["max_tokens"] / 3  ## split srt into segments with 1000 tokens
+        srt = srt.nonempty()  ## skip empty lines
+        texts = srt.texts
+        if not texts:
+            return [[0, '']]
+
+        ## tokenize every line at once, segment boundaries are then found on the cumulative token counts
+        encoding = self.get_encoding(self.roles[role]["model"])
+        counts = np.fromiter((len(x) for x in encoding.encode_batch(texts)), dtype=np.int64, count=len(texts))
+        cumsum = np.cumsum(counts)
+        start = srt.start
+        end = srt.end
+        pauses = np.append(start[1:] - end[:-1], np.inf)  ## silence after each line
+
         result = []
-        for index, row in srt.iterrows():
-            if not row['text'] :  ## skip empty lines
-                continue
-            tmp = tmp + self.estimate_token_count( row['text'])
-            tmp_str = tmp_str + ',' + row['text']
-            if tmp > token_count:
-                result.append([tmp, tmp_str])
-                tmp_str = ''
-                tmp = 0
-        
-        result.append([tmp, tmp_str])  ## last segment
+        first = 0
+        for last in self.segment_boundaries(cumsum, pauses, token_count):
+            tokens = cumsum[last - 1] - (cumsum[first - 1] if first else 0)
+            result.append([int(tokens), ','.join(texts[first:last])])
+            first = last
 
         return result
 
-    def edit_segment(self, segment):
-        prompt = self.config["roles"]["editor"]["prompt"]
+    @staticmethod
+    def segment_boundaries(cumsum, pauses, token_count, window=0.2):
+        """
+        End index (exclusive) of every segment. A segment holds at most `token_count` tokens, and
+        ends at the longest pause among its last `window` share of tokens, so sentences are rarely cut.
+        """
+        n = len(cumsum)
+        boundaries = []
+        first = 0
+        base = 0
+        while first < n:
+            last = int(np.searchsorted(cumsum, base + token_count, side='right'))
+            if last >= n:
+                boundaries.append(n)
+                break
+            last = max(last, first + 1)  ## a single line longer than token_count
+            lo = int(np.searchsorted(cumsum, base + token_count * (1 - window), side='right'))
+            lo = min(max(lo, first + 1), last)
+            last = lo + int(np.argmax(pauses[lo - 1:last]))
+            boundaries.append(last)
+            base = cumsum[last - 1]
+            first = last
+        return boundaries
 
-        temperature=self.config["roles"]["editor"]["temperature"]
+    def streaming_segmenter(self, role="editor"):
+        """
+        split_srt for a transcript that is still being produced, see StreamingSegmenter.
+        """
+        return StreamingSegmenter(self.get_encoding(self.roles[role]["model"]), self.roles[role]["max_tokens"] / 3)
 
-        message=[
-                    {"role": "system", "content": prompt},
-                    {"role": "user", "content": segment}
-                ]
-        message_token_count=self.estimate_tokens_from_messages(message)
+    def role_payload(self, role, segment):
+        role_config = self.roles[role]
+        messages=[{"role": "system", "content": role_config["prompt"]},
+                  {"role": "user", "content": segment}]
 
-        payload = {
-            'messages': message,
-            #'max_tokens': message_token_count,
-            'temperature': temperature,
-            'engine': self.config["model"],
+        return {
+            'messages': messages,
+            #'max_tokens': output_token_count,
+            'temperature': role_config["temperature"],
+            'engine': role_config["model"],
         }
-        return self.get_assistant_reply(payload)
+
+    def edit_payload(self, segment):
+        return self.role_payload("editor", segment)
+
+    def summerize_payload(self, segment, output_token_count):
+        return self.role_payload("summerizer", segment)
+
+    def merge_payload(self, segment):
+        return self.role_payload("merger", segment)
+
+    def edit_segment(self, segment):
+        return self.get_assistant_reply(self.edit_payload(segment), "editor")
 
     def summerize_segment(self, segment, output_token_count):
-        prompt = self.config["roles"]["summerizer"]["prompt"]
+        return self.get_assistant_reply(self.summerize_payload(segment, output_token_count), "summerizer")
 
-        temperature=self.config["roles"]["summerizer"]["temperature"]
-        messages=[{"role": "system", "content": prompt},
-                {"role": "user", "content": segment}]
-        
-        payload = {
-            'messages': messages,
-            #'max_tokens': output_token_count,  
-            'temperature': temperature,
-            'engine': self.config["model"],
-        }
-        return self.get_assistant_reply(payload)
-    
+    def estimate_request_tokens(self, payload):
+        model = payload['engine']
+        try:
+            prompt_tokens = self.estimate_tokens_from_messages(payload['messages'], model)
+        except NotImplementedError:
+            prompt_tokens = sum(self.estimate_token_count(message['content'], model) for message in payload['messages'])
+        # the reply (edited text or keypoints) is at most about as long as the prompt
+        return prompt_tokens + payload.get('max_tokens', prompt_tokens)
+
+    def record_usage(self, role, response, latency):
+        self.usage.record(role, self.roles[role]["model"], latency, response.get('usage'), self.roles[role]["price"])
 
-    def get_assistant_reply(self, payload):
-        for i in range(5):
-            try:
-                response = openai.ChatCompletion.create(**payload)
+    def get_assistant_reply(self, payload, role):
+        """
+        The errors are raised once the limiter gave up retrying, an empty reply would become an empty summary.
+        """
+        if self.cache is not None:
+            assistant_reply = self.cache.get(payload)
+            if assistant_reply is not None:
+                return assistant_reply
+        latency = []  # of the successful attempt, the limiter may retry
+
+        def create(**kwargs):
+            start = time.perf_counter()
+            response = openai.ChatCompletion.create(**kwargs)
+            latency.append(time.perf_counter() - start)
+            return response
+
+        response = self.limiters[role].call(create, self.estimate_request_tokens(payload), **payload)
+        self.record_usage(role, response, latency[-1])
         # 提取助手的回答
-                assistant_reply = response['choices'][0]['message']['content']
+        assistant_reply = response['choices'][0]['message']['content']
+        if self.cache is not None:
+            self.cache.put(payload, assistant_reply)
+        return assistant_reply
+
+    async def aget_assistant_reply(self, payload, role):
+        """
+        Like get_assistant_reply, errors are raised once the limiter gave up retrying, so that a failed
+        segment fails the video instead of silently leaving a hole in the text.
+        """
+        if self.cache is not None:  # sqlite / redis calls, off the event loop
+            assistant_reply = await utils.run_blocking(self.cache.get, payload)
+            if assistant_reply is not None:
                 return assistant_reply
-            except:   ##打印出错信息
-                traceback.print_exc()
-                print(f"retrying get_assistant_reply, the {i+1} times ...")
-        return ''
+        latency = []
+
+        async def acreate(**kwargs):
+            start = time.perf_counter()
+            response = await openai.ChatCompletion.acreate(**kwargs)
+            latency.append(time.perf_counter() - start)
+            return response
+
+        async with self.role_slots[role]:
+            response = await self.limiters[role].acall(acreate, self.estimate_request_tokens(payload), **payload)
+        self.record_usage(role, response, latency[-1])
+        assistant_reply = response['choices'][0]['message']['content']
+        if self.cache is not None:
+            await utils.run_blocking(self.cache.put, payload, assistant_reply)
+        return assistant_reply
 
     def edit(self, srt):
         segments = self.split_srt(srt)
@@ -181,13 +315,182 @@ class SrtSummarizer:
             return 
 
     def merge_keypoints(self, keypoints):
-        tmp_str = '\n'.join(keypoints)
-        token_count = self.estimate_token_count(tmp_str)   
+        merger = self.roles["merger"]
+        for i in range(self.max_merge_rounds):
+            tmp_str = '\n'.join(keypoints)
+            token_count = self.estimate_token_count(tmp_str, merger["model"])
+            if token_count*1.3 <= merger["max_tokens"]:
+                return self.get_assistant_reply(self.merge_payload(tmp_str), "merger")
+
+            ## too long for one request: summarize token-bounded batches, then merge their summaries
+            batches = self.batch_keypoints(keypoints)
+            print(f'merge round {i+1}: {len(keypoints)} keypoints ({token_count} tokens) -> {len(batches)} batches')
+            keypoints = [self.summerize_segment(batch, 0) or batch for batch in batches]
 
-        if token_count*1.3 > self.max_token_count:
-            print('warning, the responses needed to merge are too long!', 'token_acount=', token_count)
-            print('return simple merge of response from all segments')
-            return '\n'.join(keypoints) 
+        print('warning, the responses needed to merge are still too long, return simple merge of them!')
+        return '\n'.join(keypoints)
+
+    def batch_keypoints(self, keypoints):
+        """
+        Group consecutive keypoints into batches that fit in one summarize request.
+        """
+        summerizer = self.roles["summerizer"]
+        budget = summerizer["max_tokens"] / 1.3
+        batches = []
+        batch = []
+        batch_tokens = 0
+        for key in keypoints:
+            n = self.estimate_token_count(key, summerizer["model"])
+            if batch and batch_tokens + n > budget:
+                batches.append('\n'.join(batch))
+                batch = []
+                batch_tokens = 0
+            batch.append(key)
+            batch_tokens += n
+        if batch:
+            batches.append('\n'.join(batch))
+        return batches
+
+    ## async path: all the segments of a video are sent concurrently, gather keeps their order
+    async def aedit(self, srt):
+        segments = await asyncio.get_running_loop().run_in_executor(None, self.split_srt, srt)
+        return list(await asyncio.gather(*(self.aedit_segment(seg[1]) for seg in segments)))
+
+    async def aedit_segment(self, segment):
+        return await self.aget_assistant_reply(self.edit_payload(segment), "editor")
+
+    async def asummarize(self, paragraphs):
+        paragraphs = [seg for seg in paragraphs if seg]  # skip empty segments
+        replies = await asyncio.gather(*(
+            self.aget_assistant_reply(self.summerize_payload(seg, int(self.estimate_token_count(seg)/5)), "summerizer")
+            for seg in paragraphs))
+        return await self.areduce_keypoints(replies)
+
+    async def areduce_keypoints(self, replies):
+        keypoints = [key for key in replies if key]
+        if len(keypoints) < len(replies):
+            print(f"{len(replies)-len(keypoints)} keys are empty, skip these segments!")
+
+        xx=len(keypoints)
+        if  xx>1:
+            return await self.amerge_keypoints(keypoints)
+        elif xx==1:
+            return keypoints[0]
         else:
-            res = self.summerize_segment(tmp_str, self.max_token_count-token_count )
-            return res
+            return
+
+    ## single pass mode: one call per segment returns both the edited text and its keypoints
+    def edit_summerize_payload(self, segment):
+        return self.role_payload("editor_summerizer", segment)
+
+    @staticmethod
+    def parse_edit_summerize(reply):
+        """
+        Parse {"text": ..., "keypoints": ...} out of the reply, None if the model did not follow the format.
+        """
+        reply = reply.strip()
+        if reply.startswith('```'):  ## markdown code block
+            reply = reply.strip('`')
+            reply = reply[reply.find('{'):]
+        try:
+            data = json.loads(reply[:reply.rfind('}') + 1])
+            text, keypoints = data["text"], data["keypoints"]
+        except (ValueError, KeyError, TypeError):
+            return None
+        if isinstance(keypoints, list):
+            keypoints = '\n'.join(str(key) for key in keypoints)
+        if not isinstance(text, str) or not text:
+            return None
+        return text, keypoints
+
+    async def aedit_summarize_segment(self, segment):
+        parsed = self.parse_edit_summerize(await self.aget_assistant_reply(self.edit_summerize_payload(segment),
+                                                                           "editor_summerizer"))
+        if parsed is not None:
+            return parsed
+        print("warning: the reply is not in the expected json format, edit and summarize this segment separately")
+        text = await self.aget_assistant_reply(self.edit_payload(segment), "editor")
+        return text, await self.aget_assistant_reply(self.summerize_payload(text, int(self.estimate_token_count(text)/5)),
+                                                     "summerizer")
+
+    async def aedit_and_summarize(self, srt):
+        """
+        :return: (paragraphs, keypoints) with one entry per segment, keypoints still have to be merged
+        """
+        segments = await asyncio.get_running_loop().run_in_executor(None, self.split_srt, srt, "editor_summerizer")
+        results = await asyncio.gather(*(self.aedit_summarize_segment(seg[1]) for seg in segments))
+        return [text for text, _ in results], [keypoints for _, keypoints in results]
+
+    async def amerge_keypoints(self, keypoints):
+        ## hierarchical reduce, the batches of every round are summarized in parallel, the final merge by the merger
+        merger = self.roles["merger"]
+        for i in range(self.max_merge_rounds):
+            tmp_str = '\n'.join(keypoints)
+            token_count = self.estimate_token_count(tmp_str, merger["model"])
+            if token_count*1.3 <= merger["max_tokens"]:
+                return await self.aget_assistant_reply(self.merge_payload(tmp_str), "merger")
+
+            batches = self.batch_keypoints(keypoints)
+            print(f'merge round {i+1}: {len(keypoints)} keypoints ({token_count} tokens) -> {len(batches)} batches')
+            replies = await asyncio.gather(*(self.aget_assistant_reply(self.summerize_payload(batch, 0), "summerizer")
+                                             for batch in batches))
+            keypoints = [reply or batch for reply, batch in zip(replies, batches)]
+
+        print('warning, the responses needed to merge are still too long, return simple merge of them!')
+        return '\n'.join(keypoints)
+
+
+class StreamingSegmenter:
+    """
+    Incremental split_srt: the lines are fed one by one while they are transcribed, and every segment is
+    returned as soon as it is complete, with the same boundaries split_srt finds on the whole transcript.
+    """
+
+    def __init__(self, encoding, token_count, window=0.2):
+        self.encoding = encoding
+        self.token_count = token_count
+        self.window = window
+        self.texts = []
+        self.counts = []
+        self.pauses = []  # silence after each line but the last one
+        self.last_end = None
+        self.tokens = 0
+
+    def feed(self, start, duration, text):
+        """
+        :return: the segments completed by this line, [[tokens, text], ...]
+        """
+        if not text:  ## skip empty lines
+            return []
+        if self.texts:
+            self.pauses.append(start - self.last_end)
+        self.last_end = start + duration
+        self.texts.append(text)
+        self.counts.append(len(self.encoding.encode(text)))
+        self.tokens += self.counts[-1]
+
+        ## a segment is complete once the lines after it are known, i.e. the buffer holds more than one segment
+        result = []
+        while self.tokens > self.token_count:
+            result.append(self.cut())
+        return result
+
+    def flush(self):
+        """
+        :return: the remaining segments, once the whole transcript was fed
+        """
+        result = []
+        while self.texts:
+            result.append(self.cut())
+        return result
+
+    def cut(self):
+        cumsum = np.cumsum(self.counts)
+        pauses = np.append(self.pauses, np.inf)  ## the silence after the last line is not known yet
+        last = SrtSummarizer.segment_boundaries(cumsum, pauses, self.token_count, self.window)[0]
+        segment = [int(cumsum[last - 1]), ','.join(self.texts[:last])]
+        del self.texts[:last]
+        del self.counts[:last]
+        del self.pauses[:last]
+        self.tokens -= segment[0]
+        return segment
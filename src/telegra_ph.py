@@ -1,4 +1,3 @@
-import time
 import utils
 import os
 import json
@@ -48,14 +47,11 @@ def publish2telegraph(access_token, title, paragraphs):
         
     return page_urls
 
-## srt is a pandas dataframe, with columns: start, duration, text
+## srt is a transcript.Transcript, with columns: start, duration, text
 def srt2paragraphs(srt):
-    paragraphs =  []
-    for index, row in srt.iterrows():
-        t0=time.gmtime( int(row['start']) )
-        xx=time.strftime("%H:%M:%S", t0) +"\t"
-        paragraphs.append(xx+f"{row['text']}\n")
-    return paragraphs
+    seconds = srt.start.astype(int)
+    hours, minutes, seconds = (seconds // 3600).tolist(), (seconds // 60 % 60).tolist(), (seconds % 60).tolist()
+    return [f"{h:02d}:{m:02d}:{s:02d}\t{text}\n" for h, m, s, text in zip(hours, minutes, seconds, srt.texts)]
 
 def publish_srt_to_telegraph(access_token, title, srt):
     paragraphs=srt2paragraphs(srt)
@@ -94,8 +90,8 @@ def post_telegraph_page(base_url, params):
     else:
         print("Error:", json_response.get("error"))
         print(f"Generate the 1th page url failed") 
-        exit(1)
-        return None
+        # an error (FLOOD_WAIT_x, ...) fails this video only, the publish stage retries it
+        raise RuntimeError(json_response.get("error"))
 
 def generate_page_navigation(page_urls): 
     result={'tag':'p', 'children':["Page list:\t"]}
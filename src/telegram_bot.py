@@ -2,11 +2,11 @@ import logging
 import asyncio
 import time
 import os
-import json
 import redis
 import httpx
 import pytube
 from db_query import *
+from video_queue import VideoQueue
 from aiogram import Bot, Dispatcher, html
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, Message, CallbackQuery
 from aiogram.enums import ParseMode
@@ -34,6 +34,7 @@ class VideoBot:
         self.conn: MySQLClientConnection = MySQLClientConnection(db_config)
         self.redis_client = redis.Redis(
             host=redis_config['host'], port=redis_config['port'], decode_responses=True)
+        self.video_queue = VideoQueue(self.redis_client, VIDEO_POOL_NAME)
 
     async def set_menu(self):
         commands = [
@@ -194,16 +195,7 @@ class VideoBot:
 
             # print(video_data)
 
-            priority_queue_key = "priority_queue"
-            existing_videos = self.redis_client.hget(VIDEO_POOL_NAME, priority_queue_key)
-
-            if existing_videos:
-                old_videos = json.loads(existing_videos)
-                old_videos.append(video_data)
-            else:
-                old_videos = [video_data]
-
-            self.redis_client.hset(VIDEO_POOL_NAME, priority_queue_key, json.dumps(old_videos))
+            self.video_queue.push([video_data], priority=True)
 
             await message.answer('✅ The video has entered the queue. Please be patient and wait!')
             await state.clear()
@@ -0,0 +1,83 @@
+import numpy as np
+import pyarrow as pa
+
+
+class Transcript:
+    """
+    Columnar transcript (subtitles or whisper output):
+        start, duration  float64 arrays, seconds
+        offsets          int64 array of len(transcript) + 1, line i is buffer[offsets[i]:offsets[i + 1]]
+        buffer           the texts of all the lines, concatenated in one str
+
+    Built once from the rows of a parser or of whisper, then read column-wise, without one object per line.
+    """
+
+    __slots__ = ("start", "duration", "offsets", "buffer")
+
+    def __init__(self, start, duration, offsets, buffer):
+        self.start = start
+        self.duration = duration
+        self.offsets = offsets
+        self.buffer = buffer
+
+    @classmethod
+    def from_columns(cls, start, duration, texts):
+        lengths = np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts))
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return cls(np.asarray(start, dtype=np.float64), np.asarray(duration, dtype=np.float64), offsets,
+                   ''.join(texts))
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        :param rows: iterable of (start, duration, text)
+        """
+        rows = list(rows)
+        if not rows:
+            return cls.from_columns([], [], [])
+        start, duration, texts = zip(*rows)
+        return cls.from_columns(start, duration, texts)
+
+    @classmethod
+    def from_arrow(cls, table: pa.Table):
+        return cls.from_columns(table.column('start').to_numpy(), table.column('duration').to_numpy(),
+                                table.column('text').to_pylist())
+
+    def to_arrow(self) -> pa.Table:
+        return pa.table({'start': self.start, 'duration': self.duration, 'text': pa.array(self.texts, pa.string())})
+
+    def __len__(self):
+        return len(self.start)
+
+    def __repr__(self):
+        return f"Transcript({len(self)} lines, {self.end.max() if len(self) else 0:.0f} seconds)"
+
+    @property
+    def end(self):
+        return self.start + self.duration
+
+    @property
+    def texts(self):
+        buffer = self.buffer
+        offsets = self.offsets.tolist()
+        return [buffer[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+    def text(self, i):
+        return self.buffer[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        """
+        Yield (start, duration, text) of every line.
+        """
+        return zip(self.start.tolist(), self.duration.tolist(), self.texts)
+
+    def nonempty(self):
+        """
+        The transcript without its empty lines.
+        """
+        mask = np.diff(self.offsets) > 0
+        if mask.all():
+            return self
+        texts = [text for text, keep in zip(self.texts, mask.tolist()) if keep]
+        return Transcript.from_columns(self.start[mask], self.duration[mask], texts)
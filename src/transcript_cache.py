@@ -0,0 +1,86 @@
+import os
+import time
+import hashlib
+from urllib.parse import urlparse, parse_qs
+import pyarrow as pa
+import pyarrow.parquet as pq
+from transcript import Transcript
+
+# where a transcript comes from, in the order they are preferred
+SOURCES = ("manual", "auto", "whisper")
+
+
+def video_id(url):
+    """
+    The youtube video id of a link (watch?v=, youtu.be/, shorts/, live/), a hash of the link for other sites.
+    """
+    parsed = urlparse(url)
+    if parsed.hostname and parsed.hostname.endswith("youtube.com"):
+        if 'v' in parse_qs(parsed.query):
+            return parse_qs(parsed.query)['v'][0]
+        parts = parsed.path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] in ("shorts", "live", "embed"):
+            return parts[1]
+    if parsed.hostname == "youtu.be":
+        return parsed.path.strip('/')
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+class TranscriptCache:
+    """
+    Transcripts on disk, one parquet file per video and source: <path>/<video_id>.<source>.parquet
+
+    A transcript is kept as soon as it is downloaded or transcribed, so a video failing in a later stage
+    (llm, telegra.ph, ...) is retried without downloading its audio and running whisper again.
+    Files older than `ttl_days` are removed.
+    """
+
+    def __init__(self, path="transcripts", ttl_days=30):
+        self.path = path
+        self.ttl = ttl_days * 3600 * 24
+        self.last_prune = 0
+        os.makedirs(path, exist_ok=True)
+
+    def file(self, vid, source):
+        return os.path.join(self.path, f"{vid}.{source}.parquet")
+
+    def get(self, url, sources=SOURCES):
+        """
+        :return: (srt, source) of the preferred cached transcript of the video, (None, None) if there is none
+        """
+        vid = video_id(url)
+        for source in sources:
+            path = self.file(vid, source)
+            if not os.path.exists(path):
+                continue
+            try:
+                return Transcript.from_arrow(pq.read_table(path)), source
+            except (OSError, pa.ArrowException) as e:  # truncated or corrupted file
+                print(f"transcript cache: can not read {path}: {repr(e)}")
+                os.remove(path)
+        return None, None
+
+    def put(self, url, source, srt):
+        if srt is None or len(srt) == 0:
+            return
+        path = self.file(video_id(url), source)
+        table = srt.to_arrow()
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            pq.write_table(table, tmp, compression='zstd')
+            os.replace(tmp, path)  # readers never see a partial file
+        except (OSError, pa.ArrowException) as e:  # the video goes on without cache
+            print(f"transcript cache: can not write {path}: {repr(e)}")
+
+        if time.time() - self.last_prune > 3600:
+            self.prune()
+
+    def prune(self):
+        self.last_prune = time.time()
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                if self.last_prune - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
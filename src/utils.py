@@ -14,11 +14,60 @@ def get_http_responce(url, method, params):
 
 
 import time
-from functools import wraps
+import asyncio
+import threading
+from functools import wraps, partial
 from typing import Callable, Any
 from time import sleep
 
 
+async def run_blocking(func: Callable, *args, **kwargs) -> Any:
+    """
+    Run a blocking function in the event loop's default executor, so that slow
+    network / disk / GPU calls do not stall the other coroutines.
+
+    :param func: The blocking function
+    :return: The result of func(*args, **kwargs)
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(func, *args, **kwargs))
+
+
+async def iterate_blocking(func: Callable, *args, **kwargs):
+    """
+    Run a blocking generator in the event loop's default executor, and yield its items as they come.
+
+    :param func: The generator function
+    :return: An async iterator over func(*args, **kwargs), the error of the generator is raised at the end.
+             When the iterator is closed early (cancelled, or the consumer failed), the generator is stopped
+             and closed after its current item, so it releases what it holds.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    end = object()
+    stop = threading.Event()
+
+    def run():
+        items = func(*args, **kwargs)
+        try:
+            for item in items:
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+        finally:
+            items.close()
+            if not stop.is_set():  # nobody reads the queue anymore, the loop may even be closed
+                loop.call_soon_threadsafe(queue.put_nowait, end)
+
+    future = loop.run_in_executor(None, run)
+    try:
+        while (item := await queue.get()) is not end:
+            yield item
+        await future  # raises the error of the generator, if any
+    finally:
+        stop.set()
+
+
 def retry(retries: int = 3, delay: float = 1) -> Callable:
     """
     Attempt to call a function, if it fails, try again with a specified delay.
@@ -33,6 +82,24 @@ def retry(retries: int = 3, delay: float = 1) -> Callable:
         raise ValueError('Are you high, mate?')
 
     def decorator(func: Callable) -> Callable:
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs) -> Any:
+                for i in range(1, retries + 1):
+                    try:
+                        print(f'Running ({i}): {func.__name__}()')
+                        return await func(*args, **kwargs)
+                    except Exception as e:
+                        if i == retries:
+                            print(f'Error: {repr(e)}.')
+                            print(f'"{func.__name__}()" failed after {retries} retries.')
+                            break
+                        else:
+                            print(f'Error: {repr(e)} -> Retrying...')
+                            await asyncio.sleep(delay)
+
+            return async_wrapper
+
         @wraps(func)
         def wrapper(*args, **kwargs) -> Any:
             for i in range(1, retries + 1):  # 1 to retries + 1 since upper bound is exclusive
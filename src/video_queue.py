@@ -0,0 +1,264 @@
+import json
+import os
+import socket
+import time
+import redis
+
+PRIORITY_QUEUE_KEY = "priority_queue"
+
+
+class VideoQueue:
+    """
+    The video pool, stored as two redis streams read through a consumer group:
+        <name>:priority  videos added by users with /add_video, always served first
+        <name>:videos    new videos found in the subscribed channels
+
+    XADD / XREADGROUP are atomic and O(1), so the bot, the pool updater and the summarizer can
+    push and pop concurrently without a read-modify-write of the whole pool.
+
+    Every summarizer process is a consumer of the group, so several workers can share one redis.
+    A popped video is leased to its consumer until it is acked; the consumer renews the lease with
+    heartbeat(), and videos whose lease expired (the worker crashed) are reclaimed by the others.
+    """
+
+    def __init__(self, redis_client: redis.Redis, name="video_pool", group="summarizer", consumer=None,
+                 lease_timeout=600, max_deliveries=3):
+        self.redis_client = redis_client
+        self.name = name
+        self.priority_stream = f"{name}:priority"
+        self.video_stream = f"{name}:videos"
+        self.streams = (self.priority_stream, self.video_stream)
+        self.group = group
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_timeout = lease_timeout  # seconds
+        self.max_deliveries = max_deliveries
+        self.leased = {stream: set() for stream in self.streams}  # entries popped by this consumer, not acked yet
+        self.reclaimed = []  # entries taken over from dead consumers, waiting to be served
+        self.last_reclaim = 0
+        self.claimed = set()  # videos this consumer is summarizing, see claim_video()
+
+    def ensure_group(self):
+        for stream in self.streams:
+            try:
+                self.redis_client.xgroup_create(stream, self.group, id='0', mkstream=True)
+            except redis.ResponseError as e:
+                if 'BUSYGROUP' not in str(e):  # group already exists
+                    raise
+
+    def push(self, videos, priority=False):
+        stream = self.priority_stream if priority else self.video_stream
+        pipe = self.redis_client.pipeline(transaction=False)
+        for video in videos:
+            pipe.xadd(stream, {"video": json.dumps(video)})
+        pipe.execute()
+
+    def pop(self):
+        """
+        Lease the next video: videos reclaimed from dead consumers, then priority videos, then channel videos.
+
+        :return: (entry, video, priority), or (None, None, False) if the pool is empty.
+                 The entry must be given back to ack() once the video is done.
+        """
+        if time.time() - self.last_reclaim > self.lease_timeout / 2:
+            self.reclaim()
+
+        while self.reclaimed:
+            stream, entry_id, fields = self.reclaimed.pop(0)
+            if fields:  # None if the entry was deleted meanwhile
+                return self.lease(stream, entry_id, fields)
+            self.leased[stream].discard(entry_id)
+
+        for stream in self.streams:
+            res = self.redis_client.xreadgroup(self.group, self.consumer, {stream: '>'}, count=1)
+            if not res or not res[0][1]:
+                continue
+            entry_id, fields = res[0][1][0]
+            return self.lease(stream, entry_id, fields)
+        return None, None, False
+
+    def lease(self, stream, entry_id, fields):
+        self.leased[stream].add(entry_id)
+        return (stream, entry_id), json.loads(fields["video"]), stream == self.priority_stream
+
+    def ack(self, entry):
+        stream, entry_id = entry
+        self.leased[stream].discard(entry_id)
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.xack(stream, self.group, entry_id)
+        pipe.xdel(stream, entry_id)
+        pipe.execute()
+
+    def heartbeat(self):
+        """
+        Renew the lease of every video this consumer is working on (claiming an entry resets its idle time),
+        and of the videos it is summarizing. Leases already taken over by another consumer (this one stalled
+        longer than lease_timeout) are given up instead of being claimed back.
+
+        :return: False if some leases could not be renewed this time, heartbeat() should be called again soon
+        """
+        renewed = True
+        for stream, entry_ids in self.leased.items():
+            if entry_ids:
+                renewed = self.renew_leases(stream) and renewed
+        for link in list(self.claimed):
+            if not self.acquire_lock(f"video:{link}", int(self.lease_timeout)):
+                print(f"lost the claim of video {link}")
+                self.claimed.discard(link)
+        return renewed
+
+    def renew_leases(self, stream):
+        """
+        XCLAIM the leased entries still pending for this consumer, in a transaction watching the stream,
+        so that an XAUTOCLAIM of another consumer between the check and the claim aborts the renewal.
+
+        :return: False if the stream kept changing (XADDs of the bot and the poller also abort the transaction)
+        """
+        with self.redis_client.pipeline(transaction=True) as pipe:
+            for _ in range(3):  # retry a few times right away
+                try:
+                    pipe.watch(stream)
+                    pending = pipe.xpending_range(stream, self.group, min='-', max='+',
+                                                  count=len(self.leased[stream]) + 1000, consumername=self.consumer)
+                    owned = {item['message_id'] for item in pending}
+                    for entry_id in self.leased[stream] - owned:
+                        print(f"lost the lease of video {entry_id} of {stream}, taken over by another consumer")
+                    self.leased[stream] &= owned
+                    pipe.multi()
+                    if self.leased[stream]:
+                        pipe.xclaim(stream, self.group, self.consumer, min_idle_time=0,
+                                    message_ids=list(self.leased[stream]), justid=True)
+                    pipe.execute()
+                    return True
+                except redis.WatchError:
+                    continue
+        print(f"renewing the leases of {stream} gave up, the stream kept changing, retrying on the next heartbeat")
+        return False
+
+    def reclaim(self):
+        """
+        Take over the videos whose lease expired, i.e. their consumer stopped sending heartbeats.
+        Videos delivered more than max_deliveries times are dropped, they probably crash the worker.
+        The others are leased right away, so heartbeat() renews them while they wait to be served by pop().
+        """
+        self.last_reclaim = time.time()
+        min_idle_time = int(self.lease_timeout * 1000)
+        for stream in self.streams:
+            res = self.redis_client.xautoclaim(stream, self.group, self.consumer, min_idle_time,
+                                               start_id='0-0', count=100)
+            for entry_id, fields in res[1]:
+                pending = self.redis_client.xpending_range(stream, self.group, min=entry_id, max=entry_id, count=1)
+                if pending and pending[0]['times_delivered'] > self.max_deliveries:
+                    print(f"drop video {entry_id} of {stream}, delivered {pending[0]['times_delivered']} times")
+                    self.ack((stream, entry_id))
+                    continue
+                print(f"reclaimed video {entry_id} of {stream} from a dead consumer")
+                self.leased[stream].add(entry_id)
+                self.reclaimed.append((stream, entry_id, fields))
+
+        self.remove_dead_consumers()
+
+    def remove_dead_consumers(self):
+        for stream in self.streams:
+            for consumer in self.redis_client.xinfo_consumers(stream, self.group):
+                if consumer['name'] != self.consumer and consumer['pending'] == 0 \
+                        and consumer['idle'] > self.lease_timeout * 1000 * 10:
+                    self.redis_client.xgroup_delconsumer(stream, self.group, consumer['name'])
+
+    def acquire_lock(self, name, ttl):
+        """
+        Take (or renew) a lock named `name` for `ttl` seconds, used to run a task on one node only.
+
+        :return: True if this consumer holds the lock
+        """
+        key = f"{self.name}:lock:{name}"
+        if self.redis_client.set(key, self.consumer, nx=True, ex=ttl):
+            return True
+        return self.if_lock_owner(key, lambda pipe: pipe.expire(key, ttl))
+
+    def release_lock(self, name):
+        key = f"{self.name}:lock:{name}"
+        self.if_lock_owner(key, lambda pipe: pipe.delete(key))
+
+    def if_lock_owner(self, key, command):
+        """
+        Compare-and-set: queue `command` on a transaction only if this consumer holds the lock `key`.
+        The key is watched, so the command is not applied if the lock expired and was taken by another
+        consumer after the check.
+
+        :return: True if the command was applied
+        """
+        with self.redis_client.pipeline(transaction=True) as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.get(key) != self.consumer:
+                    return False
+                pipe.multi()
+                command(pipe)
+                pipe.execute()
+                return True
+            except redis.WatchError:  # the lock changed hands meanwhile
+                return False
+
+    def claim_video(self, link):
+        """
+        Claim the summarization of a video, so that it is summarized by one worker only
+        even if several subscribers' copies of it are leased to different workers.
+
+        :return: True if this consumer should summarize the video
+        """
+        if self.acquire_lock(f"video:{link}", int(self.lease_timeout)):
+            self.claimed.add(link)
+            return True
+        return False
+
+    def video_claimed(self, link):
+        return self.redis_client.exists(f"{self.name}:lock:video:{link}") > 0
+
+    def release_video(self, link):
+        self.claimed.discard(link)
+        self.release_lock(f"video:{link}")
+
+    def __len__(self):
+        return sum(self.redis_client.xlen(stream) for stream in self.streams)
+
+    def migrate_legacy_pool(self):
+        """
+        One-shot migration of the old pool layout ({channel_url: json list of videos} in a hash named <name>)
+        into the streams. Safe to call on every start, it does nothing once the hash is gone.
+
+        :return: the number of migrated videos
+        """
+        if self.redis_client.type(self.name) != 'hash':
+            return 0
+
+        # rename first, writers still using the old layout then start a new hash instead of being lost
+        legacy_name = f"{self.name}:legacy"
+        try:
+            if not self.redis_client.renamenx(self.name, legacy_name):  # another worker is migrating it right now
+                return 0
+        except redis.ResponseError:  # the hash was renamed by another worker since the type check
+            return 0
+        count = 0
+        for channel, videos in self.redis_client.hgetall(legacy_name).items():
+            videos = json.loads(videos)
+            if videos:
+                self.push(videos, priority=channel == PRIORITY_QUEUE_KEY)
+                count += len(videos)
+        self.redis_client.delete(legacy_name)
+        print(f"migrated {count} videos from the legacy video pool {self.name}")
+        return count
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Migrate the legacy video pool hash to redis streams')
+    parser.add_argument('-c', '--config', type=str)
+    args = parser.parse_args()
+
+    config = json.load(open(args.config, 'r', encoding='utf-8'))
+    redis_client = redis.Redis(
+        host=config['redis_info']['host'], port=config['redis_info']['port'], decode_responses=True)
+    video_queue = VideoQueue(redis_client)
+    video_queue.ensure_group()
+    video_queue.migrate_legacy_pool()
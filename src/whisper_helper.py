@@ -1,17 +1,164 @@
-import torch
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import ctranslate2
 from faster_whisper import WhisperModel
-import pandas as pd
+from faster_whisper.audio import decode_audio
+from faster_whisper.vad import VadOptions, get_speech_timestamps
+from transcript import Transcript
+from audio_preprocess import SAMPLING_RATE, AudioPreprocessor
+
+
+def select_device(device='auto'):
+    """
+    'auto' picks cuda if ctranslate2 sees a GPU, cpu otherwise.
+    """
+    if device == 'auto':
+        return 'cuda' if ctranslate2.get_cuda_device_count() > 0 else 'cpu'
+    return device
+
 
 class audio2text:
-    def __init__(self, model='large-v2', gpu_index=0):
-        device = torch.device("cuda:"+str(gpu_index))
-        self.model = WhisperModel(model, device='cuda', device_index= gpu_index, compute_type="float16")
-        #self.model.to(device)
-    def process(self, path):
-        result=[]
-        segments, info = self.model.transcribe(path, beam_size=5)
-        for index, item in enumerate(segments):
-            tmp = pd.DataFrame({'start': [item.start], 'duration': [item.end-item.start], 'text': [item.text]}, index=[index])
-            result.append(tmp)
-        return pd.concat(result, axis=0)
-    
+    """
+    :param device: cuda, cpu or auto
+    :param compute_type: precision on the GPU, default float16
+    :param cpu_compute_type: precision on the CPU, int8 (fastest) or int8_float32
+    :param cpu_model: model used on the CPU, a smaller one than `model` keeps CPU-only nodes usable
+    :param cpu_threads: threads per transcription on the CPU, 0 = ctranslate2 default
+    :param num_workers: number of transcriptions that can run in parallel from different threads
+    :param parallel_workers: processes transcribing the chunks of one audio in parallel, each loads its own model.
+                             1 = the whole audio in one transcribe call of this process. On a GPU all the
+                             copies go to gpu_index, so GPU memory grows linearly with parallel_workers
+    :param chunk_seconds: longest chunk, the audio is cut in the silences found by the VAD
+    :param preprocessor: AudioPreprocessor shortening the audio before the transcription, None = whole audio
+    """
+
+    def __init__(self, model='large-v2', gpu_index=0, device='auto', compute_type='float16',
+                 cpu_compute_type='int8', cpu_model=None, cpu_threads=0, num_workers=1,
+                 parallel_workers=1, chunk_seconds=600, preprocessor=None):
+        self.device = select_device(device)
+        self.preprocessor = preprocessor
+        self.parallel_workers = parallel_workers
+        self.chunk_seconds = chunk_seconds
+        self.pool = None
+        if parallel_workers > 1:
+            if self.device == 'cuda':
+                print(f"Warning: {parallel_workers} worker processes each load {model} on GPU {gpu_index}, "
+                      f"{parallel_workers} times the GPU memory of one model")
+            # the models are loaded by the worker processes
+            self.options = dict(model=model, gpu_index=gpu_index, device=device, compute_type=compute_type,
+                                cpu_compute_type=cpu_compute_type, cpu_model=cpu_model, cpu_threads=cpu_threads,
+                                num_workers=num_workers)
+            self.model = None
+            return
+
+        if self.device == 'cpu':
+            model = cpu_model or model
+            compute_type = cpu_compute_type
+        print(f"whisper model {model} on {self.device} ({compute_type})")
+        self.model = WhisperModel(model, device=self.device, device_index=gpu_index, compute_type=compute_type,
+                                  cpu_threads=cpu_threads, num_workers=num_workers)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        :param config: the faster_whisper section of the config
+        """
+        return cls(config.get('model', 'large-v2'), config.get('gpu_index', 0),
+                   device=config.get('device', 'auto'),
+                   compute_type=config.get('compute_type', 'float16'),
+                   cpu_compute_type=config.get('cpu_compute_type', 'int8'),
+                   cpu_model=config.get('cpu_model'),
+                   cpu_threads=config.get('cpu_threads', 0),
+                   num_workers=config.get('num_workers', 1),
+                   parallel_workers=config.get('parallel_workers', 1),
+                   chunk_seconds=config.get('chunk_seconds', 600),
+                   preprocessor=AudioPreprocessor.from_config(config.get('preprocess', {})))
+
+    def process(self, audio):
+        """
+        :param audio: path of an audio file, or 16 kHz mono float32 samples
+        """
+        return Transcript.from_rows(self.stream(audio))
+
+    def stream(self, audio):
+        """
+        Yield (start, duration, text) as soon as every segment is decoded, the text can be processed
+        while the rest of the audio is still transcribed.
+        The timestamps are on the timeline of the original audio, even if it was preprocessed.
+        """
+        if self.preprocessor is None:
+            yield from self.transcribe_stream(audio)
+            return
+        audio, timeline = self.preprocessor.process(audio)
+        for start, duration, text in self.transcribe_stream(audio):
+            yield (*timeline.segment(start, duration), text)
+
+    def transcribe_stream(self, audio):
+        if self.parallel_workers > 1:
+            yield from self.stream_chunks(audio)
+            return
+        segments, info = self.model.transcribe(audio, beam_size=5)  # lazy generator
+        for item in segments:
+            yield item.start, item.end - item.start, item.text
+
+    def stream_chunks(self, audio):
+        """
+        Cut the audio in speech chunks, transcribe them in the worker processes and shift their
+        timestamps back to the timeline of the whole audio. The segments of a chunk are yielded
+        once it and all the chunks before it are done.
+        """
+        if isinstance(audio, str):
+            audio = decode_audio(audio, sampling_rate=SAMPLING_RATE)
+        chunks = speech_chunks(audio, self.chunk_seconds)
+        print(f"transcribing {len(audio) / SAMPLING_RATE:.0f} seconds of audio in {len(chunks)} chunks")
+        if self.pool is None:
+            # spawn, forking a process using cuda or ctranslate2 threads is not safe
+            self.pool = ProcessPoolExecutor(self.parallel_workers, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=init_worker, initargs=(self.options,))
+        futures = [self.pool.submit(transcribe_chunk, audio[start:end], start / SAMPLING_RATE)
+                   for start, end in chunks]
+        try:
+            for future in futures:
+                yield from future.result()
+        finally:
+            for future in futures:  # the consumer gave up
+                future.cancel()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+
+def speech_chunks(audio, chunk_seconds, min_silence_ms=500):
+    """
+    :return: [(start, end)] sample ranges of at most about `chunk_seconds`, made of consecutive speech
+             segments. Chunks start and end in silences, so no word is cut, and long silences are skipped.
+    """
+    vad_options = VadOptions(min_silence_duration_ms=min_silence_ms, max_speech_duration_s=chunk_seconds)
+    max_samples = chunk_seconds * SAMPLING_RATE
+    chunks = []
+    for speech in get_speech_timestamps(audio, vad_options):
+        if chunks and speech['end'] - chunks[-1][0] <= max_samples:
+            chunks[-1][1] = speech['end']
+        else:
+            chunks.append([speech['start'], speech['end']])
+    return [tuple(chunk) for chunk in chunks]
+
+
+## worker processes of audio2text.process_chunks, each one holds a model
+_worker_model = None
+
+
+def init_worker(options):
+    global _worker_model
+    _worker_model = audio2text(**options)
+
+
+def transcribe_chunk(audio, offset):
+    """
+    :param offset: start of the chunk in the whole audio, seconds
+    :return: [(start, duration, text)] on the timeline of the whole audio
+    """
+    segments, info = _worker_model.model.transcribe(audio, beam_size=5)
+    return [(item.start + offset, item.end - item.start, item.text) for item in segments]
@@ -1,88 +1,227 @@
 import youtube_dl
-import  utils
-import json
-import pandas as pd
-from whisper_helper import audio2text
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+import numpy as np
+import captions
+from captions import CaptionResolver
+from whisper_helper import audio2text, SAMPLING_RATE
 import os
 
+# the smallest audio-only stream that is still good enough for whisper, never a video
+AUDIO_FORMAT = "worstaudio[abr>=32]/worstaudio"
+# memory of one second of decoded audio: the int16 output of ffmpeg and its float32 copy
+PCM_BYTES_PER_SECOND = SAMPLING_RATE * (2 + 4)
+
+
 class SubtitleDownloader:
-    def __init__(self, ydl_opts, audio2text_tool):
+    """
+    Audio is only needed for videos without captions. It is decoded by ffmpeg straight from the stream url
+    to 16 kHz mono samples (stream_pcm), or else downloaded into a temp dir of its own under `temp_dir`,
+    removed by cleanup() once transcribed. The files of all the jobs may not use more than `temp_quota_mb`.
+
+    Decoding in memory is limited to videos of known duration up to `pcm_max_seconds`, and the samples of all
+    the jobs not yet cleaned up to `pcm_memory_mb`; other videos go through the temp files. Disk and memory
+    are reserved under a lock before downloading, so concurrent downloads can not overrun the limits together.
+    """
+
+    def __init__(self, ydl_opts, audio2text_tool=None, caption_resolver=None):
         ydl_opts["proxy"]=os.environ["HTTPS_PROXY"]
-        self.ydl=youtube_dl.YoutubeDL(ydl_opts)
+        ydl_opts.setdefault("format", AUDIO_FORMAT)
+        self.ydl_opts=ydl_opts
         self.audio2text_tool=audio2text_tool
-    def download_audio(self, url):
+        self.caption_resolver=caption_resolver or CaptionResolver()
+        self.stream_pcm = ydl_opts.get("stream_pcm", True)
+        self.temp_root = os.path.abspath(ydl_opts.get("temp_dir", "downloads"))
+        self.temp_quota = ydl_opts.get("temp_quota_mb", 2048) * 1024 * 1024
+        self.pcm_max_seconds = ydl_opts.get("pcm_max_seconds", 3600)
+        self.pcm_memory = ydl_opts.get("pcm_memory_mb", 1024) * 1024 * 1024
+        self.pcm_timeout = ydl_opts.get("pcm_timeout_seconds", 600)
+        self.lock = threading.Lock()
+        self.disk_reserved = {}  # job dir: bytes reserved while its audio is downloaded
+        self.pcm_reserved = {}  # id of the samples (or job dir while decoding): bytes
+        os.makedirs(self.temp_root, exist_ok=True)
+        self.remove_stale_dirs()
+
+    def new_ydl(self, **overrides):
+        ## YoutubeDL keeps per-download state, so every job gets its own instance (jobs run in worker threads)
+        return youtube_dl.YoutubeDL({**self.ydl_opts, **overrides})
+
+    def download_audio(self, url, ydl=None):
+        ydl = ydl or self.new_ydl()
         try:
-            self.ydl.download([url])
+            ydl.download([url])
         except youtube_dl.utils.DownloadError as e:
             print("DownloadError: ", e)
             return None
 
+    def download_pcm(self, info_dict):
+        """
+        Decode the selected audio stream with ffmpeg to 16 kHz mono float32 samples, without any file.
 
-    def json2srt(self, subtitle_json):
-        result = []
+        :return: the samples, None if the stream can not be read directly (fragmented formats, ffmpeg error)
+        """
+        url = info_dict.get('url')
+        if not url or info_dict.get('protocol', 'https') not in ('http', 'https'):
+            return None
+        cmd = ['ffmpeg', '-nostdin', '-loglevel', 'error']
+        if self.ydl_opts.get('proxy'):
+            cmd += ['-http_proxy', self.ydl_opts['proxy']]
+        headers = ''.join(f'{key}: {value}\r\n' for key, value in (info_dict.get('http_headers') or {}).items())
+        if headers:
+            cmd += ['-headers', headers]
+        cmd += ['-i', url, '-vn', '-ac', '1', '-ar', str(SAMPLING_RATE), '-f', 's16le', '-']
+        try:
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=self.pcm_timeout)
+        except FileNotFoundError:
+            print("ffmpeg not found, downloading the audio file instead")
+            return None
+        except subprocess.TimeoutExpired:
+            print(f"ffmpeg took more than {self.pcm_timeout} seconds, downloading the audio file instead")
+            return None
+        if result.returncode != 0 or not result.stdout:
+            print(f"ffmpeg failed, downloading the audio file instead: {result.stderr.decode(errors='ignore')[-500:]}")
+            return None
+        return np.frombuffer(result.stdout, np.int16).astype(np.float32) / 32768.0
+
+    def temp_usage(self):
+        usage = 0
+        for root, _, files in os.walk(self.temp_root):
+            for name in files:
+                try:
+                    usage += os.path.getsize(os.path.join(root, name))
+                except FileNotFoundError:
+                    pass
+        return usage
+
+    def reserve_pcm(self, job_dir, info_dict):
+        """
+        :return: True if the audio of the video may be decoded in memory, its memory is then reserved for job_dir
+        """
+        duration = info_dict.get('duration')
+        if not duration or duration > self.pcm_max_seconds:
+            return False
+        expected = int(duration * PCM_BYTES_PER_SECOND)
+        with self.lock:
+            if sum(self.pcm_reserved.values()) + expected > self.pcm_memory:
+                return False
+            self.pcm_reserved[job_dir] = expected
+        return True
+
+    def ensure_quota(self, job_dir, info_dict):
+        """
+        Reserve the disk space of the audio file for job_dir, until release_quota().
+        The files being downloaded are counted twice (reservation and partial file), which errs on the safe side.
+        """
+        expected = (info_dict.get('filesize') or info_dict.get('filesize_approx')
+                    or self.ydl_opts.get('max_filesize') or 0)
+        with self.lock:
+            usage = self.temp_usage() + sum(self.disk_reserved.values())
+            if usage + expected > self.temp_quota:
+                raise IOError(f"audio download quota exceeded: {usage} bytes used, {expected} more needed, "
+                              f"quota {self.temp_quota} bytes")
+            self.disk_reserved[job_dir] = expected
+
+    def release_quota(self, job_dir):
+        with self.lock:
+            self.disk_reserved.pop(job_dir, None)
+
+    def cleanup(self, audio):
+        """
+        Remove the temp dir of a downloaded audio file, or give back the memory reserved for decoded samples.
+        """
+        if not isinstance(audio, str):
+            with self.lock:
+                self.pcm_reserved.pop(id(audio), None)
+            return
+        if isinstance(audio, str) and os.path.dirname(os.path.abspath(audio)).startswith(self.temp_root + os.sep):
+            shutil.rmtree(os.path.dirname(os.path.abspath(audio)), ignore_errors=True)
+
+    def remove_stale_dirs(self, max_age=3600 * 24):
+        """
+        Temp dirs left behind by a crashed process.
+        """
+        for name in os.listdir(self.temp_root):
+            path = os.path.join(self.temp_root, name)
+            try:
+                if os.path.isdir(path) and time.time() - os.path.getmtime(path) > max_age:
+                    shutil.rmtree(path, ignore_errors=True)
+            except FileNotFoundError:
+                pass
 
-        for index, item in enumerate(subtitle_json['events']):
-            start=item["tStartMs"]/1000
-            duration= item["dDurationMs"]/1000
-            text=item['segs'][0]['utf8']
-            tmp = pd.DataFrame({'start': [start], 'duration': [duration], 'text': [text]}, index=[index])
-            result.append(tmp)
-        return pd.concat(result, axis=0)
 
-    def get_subtitles(self, url):
+    def json2srt(self, subtitle_json):
+        return captions.json3_transcript(subtitle_json)
+
+    def fetch(self, url):
+        """
+        Download the captions of a video (manual or automatic, see CaptionResolver),
+        or its audio when there are no captions at all.
+
+        :return: (subtitle, source, None) or (None, None, audio), (None, None, None) if neither is available.
+                 source is the transcript_cache source of the subtitle, audio the 16 kHz samples
+                 or the path of the audio file
+        """
+        ## the audio, if any, goes to a temp dir of this job only, created by youtube_dl when downloading
+        job_dir = os.path.join(self.temp_root, uuid.uuid4().hex)
+        ydl=self.new_ydl(outtmpl=os.path.join(job_dir, 'audio.%(ext)s'))
         try:
-            self.info_dict = self.ydl.extract_info(url, download=False)
-            if self.info_dict.get('is_live'):
+            info_dict = ydl.extract_info(url, download=False)
+            if info_dict.get('is_live'):
                 print("live video, skip: ", url)
-                return None
+                return None, None, None
         except youtube_dl.utils.DownloadError as e:
             if "This live event will begin" in str(e):
-                return None
-            
-        fname=self.ydl.prepare_filename(self.info_dict)
-        if 'subtitles' in self.info_dict:   ##   video has subtitles
-            subtitle=self.down_subtitle(self.info_dict['subtitles'])
-            return  subtitle
-        else:           ##video do not have subtitles
+                return None, None, None
+            raise
             
-            self.download_audio(url)
-            print(f" {fname} downloaded!")
+        fname=ydl.prepare_filename(info_dict)
+        subtitle, source = self.caption_resolver.resolve(info_dict)
+        if subtitle is not None:   ##   video has captions
+            return  subtitle, source, None
+        else:           ##video do not have captions, whisper is needed
+            if self.stream_pcm and self.reserve_pcm(job_dir, info_dict):
+                audio = None
+                try:
+                    audio = self.download_pcm(info_dict)
+                finally:
+                    with self.lock:  # the reservation follows the samples until cleanup()
+                        expected = self.pcm_reserved.pop(job_dir)
+                        if audio is not None:
+                            self.pcm_reserved[id(audio)] = expected
+                if audio is not None:
+                    print(f" {info_dict.get('title')}: {len(audio) / SAMPLING_RATE:.0f} seconds of audio decoded!")
+                    return None, None, audio
+
+            self.ensure_quota(job_dir, info_dict)
+            try:
+                ydl.process_info(info_dict)
+            except youtube_dl.utils.DownloadError as e:
+                print("DownloadError: ", e)
+            finally:
+                self.release_quota(job_dir)  # the file on disk is counted by temp_usage() from now on
             if(not os.path.exists(fname)):
                 print(f" {fname} download failed!")
-                return None
-            subtitle=self.audio2text_tool.process(fname)
-
-            return  subtitle
-
-
-    def down_subtitle(self, subtitles):
-        results={}
-        langs=["zh-TW", "zh-Hans", "zh"]
-         # 遍历每种语言的字幕，并下载到本地
-        proxies={
-            "http": os.environ["HTTP_PROXY"],
-            "https": os.environ["HTTPS_PROXY"]
-        }
-        for lang in subtitles:   ## 暂时只下载一种字幕，中文或者英文
-            if lang not in langs:
-                continue
-            if subtitles[lang][0]['ext']!='json3':
-                print('json3 format subtitles not found')
-                return None
-            tmp= subtitles[lang][0]     # using json3 only
-            tt=utils.get_http_responce(tmp['url'], 'GET', None)
-            subtitle_json=json.loads(tt.data)
-            subtitle=self.json2srt(subtitle_json)
-            return subtitle
-
-        return  results
+                self.cleanup(fname)
+                return None, None, None
+            print(f" {fname} downloaded!")
+            return None, None, fname
+
+    def get_subtitles(self, url):
+        subtitle, _, audio = self.fetch(url)
+        if audio is not None:
+            try:
+                subtitle=self.audio2text_tool.process(audio)
+            finally:
+                self.cleanup(audio)
+        return subtitle
 
 if __name__ == "__main__":
     ## 语音转文本工具
-    resolution=720
     ydl_opts={
-        'format': f'bestaudio/best[height={resolution}]',
-        'outtmpl': '%(title)s.%(ext)s',
+        'format': AUDIO_FORMAT,
     }
     model="large-v2"  #default large-v2
     gpu=0
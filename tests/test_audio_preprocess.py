@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+import audio_preprocess
+from audio_preprocess import AudioPreprocessor, TimelineMap, SAMPLING_RATE
+
+INTERVALS = [(10, 20), (30, 35), (50, 60)]  # kept seconds of the original audio
+
+
+def test_times_inside_an_interval():
+    timeline = TimelineMap(INTERVALS)
+    np.testing.assert_allclose(timeline.to_original([0, 5, 12, 16]), [10, 15, 32, 51])
+
+
+def test_junction_maps_to_the_next_start_or_the_previous_end():
+    timeline = TimelineMap(INTERVALS)
+    assert timeline.to_original(10) == 30  # a start time
+    assert timeline.to_original(10, side='left') == 20  # an end time
+    assert timeline.to_original(15) == 50
+    assert timeline.to_original(15, side='left') == 35
+
+
+def test_tempo_scales_the_preprocessed_times():
+    timeline = TimelineMap(INTERVALS, tempo=1.25)
+    assert timeline.to_original(4) == 15
+    assert timeline.to_original(8) == 30
+    assert timeline.to_original(8, side='left') == 20
+
+
+def test_segment():
+    timeline = TimelineMap(INTERVALS, tempo=1.25)
+    assert timeline.segment(0, 8) == (10, 10)  # the whole first interval, ends before the cut
+    assert timeline.segment(7, 2) == (18.75, 12.5)  # across the cut, the silence is in the line
+    assert timeline.segment(8, 0) == (30, 0)
+
+
+def test_times_after_the_last_interval():
+    timeline = TimelineMap(INTERVALS)
+    assert timeline.to_original(30) == 65
+
+
+def test_empty_intervals_keep_the_times():
+    timeline = TimelineMap([], tempo=1.5)
+    assert timeline.segment(1, 1) == (1.5, 1.5)
+    assert TimelineMap([]).segment(3, 2) == (3, 2)
+
+
+def noise(seconds, rng):
+    return rng.normal(0, 0.3, int(seconds * SAMPLING_RATE)).astype(np.float32)
+
+
+def silence(seconds):
+    return np.zeros(int(seconds * SAMPLING_RATE), np.float32)
+
+
+@pytest.fixture
+def speech():
+    """
+    2s silence, 2s speech, 0.2s pause, 0.8s speech, 3s silence, 2s speech
+    """
+    rng = np.random.default_rng(0)
+    return np.concatenate([silence(2), noise(2, rng), silence(0.2), noise(0.8, rng), silence(3), noise(2, rng)])
+
+
+def test_energy_intervals_cut_long_silences_only(speech):
+    preprocessor = AudioPreprocessor(method='energy', min_silence_ms=700, padding_ms=200)
+    intervals = [(start / SAMPLING_RATE, end / SAMPLING_RATE) for start, end in preprocessor.energy_intervals(speech)]
+
+    assert len(intervals) == 2  # the 0.2s pause is kept
+    (start1, end1), (start2, end2) = intervals
+    assert start1 == pytest.approx(1.8, abs=0.03) and end1 == pytest.approx(5.2, abs=0.03)
+    assert start2 == pytest.approx(7.8, abs=0.03) and end2 == len(speech) / SAMPLING_RATE
+
+
+def test_energy_intervals_of_silence(speech):
+    preprocessor = AudioPreprocessor(method='energy')
+    assert preprocessor.energy_intervals(silence(3)) == []
+    assert preprocessor.energy_intervals(silence(0)) == []
+
+
+def test_process_maps_back_to_the_original_timeline(speech, monkeypatch):
+    monkeypatch.setattr(audio_preprocess, "change_tempo", lambda samples, tempo: None)  # no ffmpeg
+    preprocessor = AudioPreprocessor(method='energy', tempo=1.25)
+    samples, timeline = preprocessor.process(speech)
+
+    intervals = preprocessor.energy_intervals(speech)
+    assert len(samples) == sum(end - start for start, end in intervals)
+    assert timeline.tempo == 1.0  # speed-up skipped
+    first_length = (intervals[0][1] - intervals[0][0]) / SAMPLING_RATE
+    start, duration = timeline.segment(first_length + 0.5, 1)
+    assert start == pytest.approx(intervals[1][0] / SAMPLING_RATE + 0.5)
+    assert duration == pytest.approx(1)
+
+
+def test_process_keeps_the_tempo_of_the_sped_up_audio(speech, monkeypatch):
+    monkeypatch.setattr(audio_preprocess, "change_tempo", lambda samples, tempo: samples[::2])
+    samples, timeline = AudioPreprocessor(method='energy', tempo=2).process(speech)
+    assert timeline.tempo == 2
+    assert timeline.to_original(0) == pytest.approx(1.8, abs=0.03)
@@ -0,0 +1,103 @@
+import datetime
+import fakeredis
+import pytest
+from conversation_store import InMemoryConversationStore, RedisConversationStore, create_conversation_store
+
+SYSTEM = {"role": "system", "content": "you are a bot"}
+
+
+def user(i):
+    return {"role": "user", "content": f"message {i}"}
+
+
+@pytest.fixture
+def redis_client():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+@pytest.fixture(params=["memory", "redis"])
+def store(request, redis_client):
+    if request.param == "redis":
+        return RedisConversationStore(redis_client, max_age_minutes=10, max_messages=3)
+    return InMemoryConversationStore(max_age_minutes=10, max_messages=3)
+
+
+def test_append_keeps_the_system_message_and_the_last_messages(store):
+    assert store.get(1) is None
+    store.reset(1, SYSTEM, 5)
+    for i in range(5):
+        store.append(1, user(i), i)
+
+    messages, token_counts = store.get(1)
+    assert messages == [SYSTEM, user(2), user(3), user(4)]
+    assert token_counts == [5, 2, 3, 4]
+
+
+def test_trim_keeps_the_system_message(store):
+    store.reset(1, SYSTEM, 5)
+    for i in range(3):
+        store.append(1, user(i), i)
+
+    store.trim(1, 2)
+    assert store.get(1) == ([SYSTEM, user(2)], [5, 2])
+    store.trim(1, 1)
+    assert store.get(1) == ([SYSTEM], [5])
+
+
+def test_reset_drops_the_history(store):
+    store.reset(1, SYSTEM, 5)
+    store.append(1, user(0), 1)
+    store.reset(1, SYSTEM, 6)
+    assert store.get(1) == ([SYSTEM], [6])
+
+
+def test_redis_append_refreshes_the_ttl(redis_client):
+    store = RedisConversationStore(redis_client, max_age_minutes=10, max_messages=3)
+    system_key, messages_key = store.keys(1)
+    store.reset(1, SYSTEM, 5)
+    redis_client.expire(system_key, 5)  # about to expire
+
+    store.append(1, user(0), 1)
+    assert redis_client.ttl(system_key) > 5
+    assert 0 < redis_client.ttl(messages_key) <= 600
+
+
+def test_redis_history_is_gone_with_its_system_message(redis_client):
+    store = RedisConversationStore(redis_client, max_age_minutes=10, max_messages=3)
+    system_key, _ = store.keys(1)
+    store.reset(1, SYSTEM, 5)
+    store.append(1, user(0), 1)
+
+    redis_client.delete(system_key)  # expired
+    assert store.get(1) is None
+
+
+def test_in_memory_histories_expire():
+    store = InMemoryConversationStore(max_age_minutes=10, max_messages=3)
+    store.reset(1, SYSTEM, 5)
+    store.reset(2, SYSTEM, 5)
+    store.last_updated[1] = datetime.datetime.now() - datetime.timedelta(minutes=11)
+    store.last_updated.move_to_end(1, last=False)
+
+    assert store.get(1) is None
+    assert 1 not in store.conversations and 1 not in store.token_counts
+    assert store.get(2) == ([SYSTEM], [5])
+
+
+def test_in_memory_append_renews_the_expiry():
+    store = InMemoryConversationStore(max_age_minutes=10, max_messages=3)
+    store.reset(1, SYSTEM, 5)
+    store.reset(2, SYSTEM, 5)
+    store.last_updated[1] = datetime.datetime.now() - datetime.timedelta(minutes=9)
+    store.last_updated.move_to_end(1, last=False)
+
+    store.append(1, user(0), 1)
+    assert list(store.last_updated) == [2, 1]  # most recently updated last
+    assert store.get(1) == ([SYSTEM, user(0)], [5, 1])
+
+
+def test_create_conversation_store(redis_client):
+    config = {"max_conversation_age_minutes": 10, "max_history_size": 4}
+    assert isinstance(create_conversation_store(config), InMemoryConversationStore)
+    store = create_conversation_store({**config, "conversation_store": "redis"}, redis_client)
+    assert isinstance(store, RedisConversationStore) and store.max_messages == 8
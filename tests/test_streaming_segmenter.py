@@ -0,0 +1,67 @@
+import random
+import pytest
+from summarizer import SrtSummarizer
+from transcript import Transcript
+
+
+class CharEncoding:
+    """
+    One token per character, tiktoken's encodings would be downloaded.
+    """
+
+    def encode(self, text):
+        return list(text)
+
+    def encode_batch(self, texts):
+        return [self.encode(text) for text in texts]
+
+
+@pytest.fixture
+def summarizer(monkeypatch):
+    monkeypatch.setattr(SrtSummarizer, "init_encoding", lambda self, model: CharEncoding())
+    config = {
+        "key": "", "api_base_url": "", "api_type": "", "api_version": "",
+        "model": "gpt-4-0613", "max_tokens": 3000,
+        "roles": {"editor": {"prompt": "edit", "temperature": 0.6},
+                  "summerizer": {"prompt": "summarize", "temperature": 0.6}},
+    }
+    return SrtSummarizer(config)
+
+
+def random_rows(n, seed=0):
+    rng = random.Random(seed)
+    rows = []
+    start = 0.0
+    for _ in range(n):
+        duration = rng.uniform(0.5, 6)
+        text = "" if rng.random() < 0.05 else "x" * rng.randint(1, 80)
+        rows.append((start, duration, text))
+        start += duration + rng.choice([0, 0, 0.1, 0.4, 1.5])
+    return rows
+
+
+@pytest.mark.parametrize("max_tokens", [300, 3000, 12000])
+def test_streaming_cuts_equal_split_srt(summarizer, max_tokens):
+    summarizer.roles["editor"]["max_tokens"] = max_tokens
+    rows = random_rows(3000)
+
+    segmenter = summarizer.streaming_segmenter("editor")
+    streamed = []
+    for row in rows:
+        streamed += segmenter.feed(*row)
+    completed_early = len(streamed)
+    streamed += segmenter.flush()
+
+    assert streamed == summarizer.split_srt(Transcript.from_rows(rows), "editor")
+    assert completed_early >= len(streamed) - 2  # segments come out during the transcription, not at the end
+
+
+def test_line_longer_than_a_segment(summarizer):
+    summarizer.roles["editor"]["max_tokens"] = 30  # 10 tokens per segment
+    rows = [(0, 1, "y" * 25), (1, 1, "short"), (2, 1, "z" * 12)]
+
+    segmenter = summarizer.streaming_segmenter("editor")
+    streamed = [segment for row in rows for segment in segmenter.feed(*row)] + segmenter.flush()
+
+    assert streamed == summarizer.split_srt(Transcript.from_rows(rows), "editor")
+    assert streamed[0] == [25, "y" * 25]
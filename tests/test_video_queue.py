@@ -0,0 +1,141 @@
+import json
+import time
+import fakeredis
+import pytest
+from video_queue import VideoQueue, PRIORITY_QUEUE_KEY
+
+LEASE_TIMEOUT = 0.05  # seconds
+
+
+@pytest.fixture
+def redis_client():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+def new_queue(redis_client, consumer, **kwargs):
+    video_queue = VideoQueue(redis_client, consumer=consumer, lease_timeout=LEASE_TIMEOUT, **kwargs)
+    video_queue.ensure_group()
+    return video_queue
+
+
+def test_pop_serves_priority_first_and_ack_removes(redis_client):
+    video_queue = new_queue(redis_client, "a")
+    video_queue.push([{"link": "channel"}])
+    video_queue.push([{"link": "user"}], priority=True)
+    assert len(video_queue) == 2
+
+    entry, video, priority = video_queue.pop()
+    assert video == {"link": "user"} and priority
+    video_queue.ack(entry)
+    entry, video, priority = video_queue.pop()
+    assert video == {"link": "channel"} and not priority
+    video_queue.ack(entry)
+
+    assert video_queue.pop() == (None, None, False)
+    assert len(video_queue) == 0
+
+
+def test_expired_lease_is_reclaimed_and_not_renewed_by_its_old_owner(redis_client):
+    dead = new_queue(redis_client, "dead")
+    alive = new_queue(redis_client, "alive")
+    dead.push([{"link": "v"}])
+    entry, _, _ = dead.pop()
+
+    time.sleep(LEASE_TIMEOUT * 2)
+    alive.reclaim()
+    reclaimed_entry, video, _ = alive.pop()
+    assert reclaimed_entry == entry and video == {"link": "v"}
+
+    dead.heartbeat()  # the stalled worker wakes up
+    assert not dead.leased[entry[0]]
+    pending = redis_client.xpending_range(entry[0], "summarizer", min='-', max='+', count=10)
+    assert [item['consumer'] for item in pending] == ["alive"]
+
+
+def test_heartbeat_keeps_the_lease(redis_client):
+    worker = new_queue(redis_client, "worker")
+    other = new_queue(redis_client, "other")
+    worker.push([{"link": "v"}])
+    entry, _, _ = worker.pop()
+
+    time.sleep(LEASE_TIMEOUT * 2)
+    worker.heartbeat()
+    other.reclaim()
+    assert other.pop() == (None, None, False)
+    assert worker.leased[entry[0]] == {entry[1]}
+
+
+def test_reclaimed_videos_waiting_to_be_served_keep_their_lease(redis_client):
+    dead = new_queue(redis_client, "dead")
+    waiting = new_queue(redis_client, "waiting")
+    other = new_queue(redis_client, "other")
+    dead.push([{"link": "v1"}, {"link": "v2"}])
+    dead.pop()
+    dead.pop()
+
+    time.sleep(LEASE_TIMEOUT * 2)
+    _, video, _ = waiting.pop()  # reclaims both, v2 waits until the pipeline takes the next video
+    assert video == {"link": "v1"}
+    for _ in range(4):
+        time.sleep(LEASE_TIMEOUT / 2)
+        assert waiting.heartbeat()
+    other.reclaim()
+    assert other.pop() == (None, None, False)
+
+    _, video, _ = waiting.pop()
+    assert video == {"link": "v2"}
+
+
+def test_video_delivered_too_often_is_dropped(redis_client):
+    first = new_queue(redis_client, "first", max_deliveries=1)
+    second = new_queue(redis_client, "second", max_deliveries=1)
+    first.push([{"link": "crashes the worker"}])
+    first.pop()
+
+    time.sleep(LEASE_TIMEOUT * 2)
+    second.reclaim()
+    assert second.pop() == (None, None, False)
+    assert len(second) == 0
+
+
+def test_release_keeps_the_claim_of_another_worker(redis_client):
+    first = new_queue(redis_client, "first")
+    second = new_queue(redis_client, "second")
+    first.lease_timeout = second.lease_timeout = 600  # claims are taken for int(lease_timeout) seconds
+    assert first.claim_video("v")
+    assert not second.claim_video("v")
+
+    redis_client.delete("video_pool:lock:video:v")  # the claim of first expired
+    assert second.claim_video("v")
+    first.release_video("v")
+    assert first.video_claimed("v")
+    assert not first.acquire_lock("video:v", 10)
+
+    second.release_video("v")
+    assert not first.video_claimed("v")
+
+
+def test_migrate_legacy_pool(redis_client):
+    redis_client.hset("video_pool", mapping={
+        "https://www.youtube.com/channel/x": json.dumps([{"link": "a"}, {"link": "b"}]),
+        PRIORITY_QUEUE_KEY: json.dumps([{"link": "p"}]),
+        "https://www.youtube.com/channel/empty": json.dumps([]),
+    })
+    video_queue = new_queue(redis_client, "a")
+
+    redis_client.hset("video_pool:legacy", "being migrated", json.dumps([{"link": "c"}]))
+    assert video_queue.migrate_legacy_pool() == 0  # by another worker
+    redis_client.delete("video_pool:legacy")
+
+    assert video_queue.migrate_legacy_pool() == 3
+    assert not redis_client.exists("video_pool") and not redis_client.exists("video_pool:legacy")
+    assert video_queue.migrate_legacy_pool() == 0
+
+    links = []
+    while True:
+        entry, video, priority = video_queue.pop()
+        if entry is None:
+            break
+        links.append((video["link"], priority))
+        video_queue.ack(entry)
+    assert links == [("p", True), ("a", False), ("b", False)]